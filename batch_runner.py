@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+import download_pixiv_images
+import download_twitter_images
+from download_engine import DEFAULT_CONCURRENCY, DownloadEngine, DownloadJob
+from fs_index import DEFAULT_INDEX_DIR
+from processed_store import DEFAULT_STORE_PATH, ProcessedStore
+from twitter_client import TwitterClient
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_SCAN_DIRS = './'
+# Job types checking scan_dirs for the media already downloaded.
+SCANNING_JOB_TYPES = ('twitter-likes', 'pixiv-bookmarks')
+
+
+@click.group()
+def cli():
+    pass
+
+
+def load_spec(spec_path: str) -> dict:
+    extension = os.path.splitext(spec_path)[1].lower()
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            # tomllib is only in the standard library since Python 3.11.
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise click.ClickException(
+                    'Python 3.11 or tomli is required to read {}'.format(spec_path))
+        with open(spec_path, 'rb') as f:
+            return tomllib.load(f)
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise click.ClickException('PyYAML is required to read {}'.format(spec_path))
+        with open(spec_path, 'r', encoding='utf-8') as f:
+            return yaml.safe_load(f)
+    with open(spec_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class BatchContext():
+
+    def __init__(self, engine: DownloadEngine, processed_store: ProcessedStore, index_dir: str):
+        self.engine = engine
+        self.processed_store = processed_store
+        self.index_dir = index_dir
+        # Scan dir -> media file names, filled once before any job starts.
+        self.root_cache = {}
+        # Cookie path -> client, the jobs of one account share its connections and rate limits.
+        self.twitter_clients = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_twitter_client(self, cookie_path: str) -> TwitterClient:
+        key = os.path.abspath(cookie_path)
+        with self.lock:
+            if key not in self.twitter_clients:
+                self.twitter_clients[key] = TwitterClient(cookie_path)
+            return self.twitter_clients[key]
+
+    def close(self):
+        for client in self.twitter_clients.values():
+            client.close()
+
+
+def run_twitter_likes(spec: dict, context: BatchContext, job: DownloadJob):
+    username = spec['username']
+    context.processed_store.import_text_file(username, '{}.processed_ids'.format(username))
+    scan_dirs = spec.get('scan_dirs', DEFAULT_SCAN_DIRS)
+    existed_images = download_twitter_images.get_existed_images(scan_dirs, context.index_dir,
+                                                                context.root_cache)
+    exclude_users = spec.get('exclude_users', '')
+    exclude_users = exclude_users.split(',') if exclude_users else []
+    client = context.get_twitter_client(spec['auth_cookie_path'])
+    download_twitter_images.download_like_images(client, context.engine, context.processed_store,
+                                                 username, spec['output_dir'], existed_images,
+                                                 exclude_users, spec.get('full', False), job)
+
+
+def run_twitter_media(spec: dict, context: BatchContext, job: DownloadJob):
+    client = context.get_twitter_client(spec['auth_cookie_path'])
+    download_twitter_images.download_tweet_images(client, context.engine, context.processed_store,
+                                                  spec['username'], spec['output_dir'],
+                                                  spec.get('full', False), job)
+
+
+def run_pixiv_bookmarks(spec: dict, context: BatchContext, job: DownloadJob):
+    user_id = str(spec['user_id'])
+    context.processed_store.import_text_file(user_id, '{}.processed_ids'.format(user_id))
+    scan_dirs = spec.get('scan_dirs', DEFAULT_SCAN_DIRS)
+    existed_images = download_pixiv_images.get_existed_images(scan_dirs, context.index_dir,
+                                                              context.root_cache)
+    api = download_pixiv_images.get_api()
+    download_pixiv_images.download_bookmarks_images(api, context.engine, context.processed_store,
+                                                    user_id, spec['output_dir'], existed_images,
+                                                    job)
+
+
+def run_pixiv_user(spec: dict, context: BatchContext, job: DownloadJob):
+    api = download_pixiv_images.get_api()
+    download_pixiv_images.download_illust_images(api, context.engine, str(spec['user_id']),
+                                                 spec['output_dir'], job)
+
+
+JOB_TYPES = {
+    'twitter-likes': run_twitter_likes,
+    'twitter-media': run_twitter_media,
+    'pixiv-bookmarks': run_pixiv_bookmarks,
+    'pixiv-user': run_pixiv_user,
+}
+
+
+def get_job_name(spec: dict) -> str:
+    return spec.get('name') or '{}:{}'.format(spec['type'],
+                                              spec.get('username') or spec.get('user_id'))
+
+
+def run_job(spec: dict, context: BatchContext, job: DownloadJob) -> dict:
+    start_time = time.monotonic()
+    status = 'ok'
+    logging.info('Job {} started'.format(job.name))
+    try:
+        os.makedirs(spec['output_dir'], exist_ok=True)
+        JOB_TYPES[spec['type']](spec, context, job)
+        job.join()
+    except Exception as e:
+        logging.exception('Job {} failed'.format(job.name))
+        status = 'error: {}'.format(e)
+    elapsed = time.monotonic() - start_time
+    logging.info('Job {} finished in {:.1f}s: {}'.format(job.name, elapsed, status))
+    return {'name': job.name, 'status': status, 'elapsed': elapsed}
+
+
+def print_report(results: list, jobs: list, elapsed: float):
+    lines = [
+        '{:<40} {:>8} {:>10} {:>8} {:>10}  {}'.format('Job', 'Seconds', 'Downloaded', 'Failed',
+                                                      'MB', 'Status')
+    ]
+    for result, job in zip(results, jobs):
+        lines.append('{:<40} {:>8.1f} {:>10} {:>8} {:>10.2f}  {}'.format(
+            result['name'], result['elapsed'], job.downloaded_files, job.failed_files,
+            job.downloaded_bytes / 1024 / 1024, result['status']))
+    lines.append('Total: {} jobs in {:.1f}s'.format(len(results), elapsed))
+    for line in lines:
+        print(line)
+        logging.info(line)
+
+
+@cli.command()
+@click.option('--spec_path', required=True, help="Job spec file, in json, toml or yaml.")
+@click.option('--log_path', default='./batch_runner.log', help="Path to output logging's log.")
+def run(spec_path, log_path):
+    logging.basicConfig(filename=log_path,
+                        format='%(asctime)s - %(threadName)s - %(message)s',
+                        level=logging.INFO)
+    spec = load_spec(spec_path)
+    settings = spec.get('settings', {})
+    job_specs = spec.get('jobs', [])
+    for job_spec in job_specs:
+        if job_spec.get('type') not in JOB_TYPES:
+            raise click.ClickException('Unknown job type {} in {}, expected one of {}'.format(
+                job_spec.get('type'), spec_path, ', '.join(JOB_TYPES)))
+
+    processed_store_path = settings.get('processed_store_path', DEFAULT_STORE_PATH)
+    concurrency = settings.get('concurrency', DEFAULT_CONCURRENCY)
+    index_dir = settings.get('index_dir', DEFAULT_INDEX_DIR)
+
+    start_time = time.monotonic()
+    with ProcessedStore(processed_store_path) as processed_store, \
+            DownloadEngine(concurrency) as engine, \
+            BatchContext(engine, processed_store, index_dir) as context:
+        # Every scan dir, the default one included, is refreshed once up front, then shared
+        # read-only by the jobs, so that root_cache is never filled from their threads.
+        for job_spec in job_specs:
+            if job_spec['type'] in SCANNING_JOB_TYPES:
+                download_twitter_images.get_existed_images(
+                    job_spec.get('scan_dirs', DEFAULT_SCAN_DIRS), context.index_dir,
+                    context.root_cache)
+
+        jobs = [
+            DownloadJob(get_job_name(job_spec), job_spec.get('concurrency'))
+            for job_spec in job_specs
+        ]
+        with ThreadPoolExecutor(max_workers=settings.get('max_jobs', DEFAULT_MAX_JOBS),
+                                thread_name_prefix='job') as executor:
+            results = list(
+                executor.map(lambda args: run_job(*args),
+                             [(job_spec, context, job) for job_spec, job in zip(job_specs, jobs)]))
+        engine.join()
+        print_report(results, jobs, time.monotonic() - start_time)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,39 @@
+import os
+import time
+
+from sqlite_store import SqliteStore
+
+DEFAULT_MANIFEST_PATH = './checked_images.sqlite'
+BATCH_SIZE = 100
+OUTCOMES = ('upgraded', 'original', 'missing')
+
+
+class CheckManifest(SqliteStore):
+    # Outcome of the last check of every file, keyed by path, size and mtime so that a file
+    # changed since then is checked again. Results are committed in batches while the scan runs,
+    # so an interrupted scan resumes from the files it had not finished.
+
+    INSERT_SQL = ('INSERT OR REPLACE INTO checked (path, size, mtime, outcome, time) '
+                  'VALUES (?, ?, ?, ?, ?)')
+
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH, batch_size: int = BATCH_SIZE):
+        super().__init__(path, batch_size)
+
+    def create_tables(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checked ('
+                          'path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                          'mtime INTEGER NOT NULL, outcome TEXT NOT NULL, '
+                          'time REAL NOT NULL)')
+
+    def is_checked(self, path: str, stat: os.stat_result, max_age: float = None) -> bool:
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime, time FROM checked WHERE path = ?',
+                                    (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return False
+        return not max_age or time.time() - row[2] < max_age
+
+    def record(self, path: str, stat: os.stat_result, outcome: str):
+        if outcome not in OUTCOMES:
+            raise ValueError('Unknown outcome: {}'.format(outcome))
+        self.queue((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, outcome, time.time()))
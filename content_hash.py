@@ -0,0 +1,112 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlite_store import SqliteStore
+
+DEFAULT_CONTENT_CACHE_PATH = './content_hashes.sqlite'
+BATCH_SIZE = 500
+# Bytes hashed at each end of a file by the partial hash, files up to twice this are hashed whole.
+PARTIAL_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 8
+
+
+def partial_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        head = f.read(2 * PARTIAL_SIZE + 1)
+        if len(head) <= 2 * PARTIAL_SIZE:
+            # Small enough to be hashed whole, so this is also its full hash.
+            digest.update(head)
+            return digest.hexdigest()
+        digest.update(head[:PARTIAL_SIZE])
+        f.seek(-PARTIAL_SIZE, os.SEEK_END)
+        digest.update(f.read(PARTIAL_SIZE))
+    return 'partial:' + digest.hexdigest()
+
+
+def full_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+HASH_FUNCTIONS = {
+    'partial': partial_hash,
+    'full': full_hash,
+}
+
+
+class ContentHashCache(SqliteStore):
+    # Partial and full content hashes of files, keyed by path and kind and valid as long as the
+    # size and mtime of the file are unchanged.
+
+    INSERT_SQL = ('INSERT OR REPLACE INTO content_hashes (path, kind, size, mtime, digest) '
+                  'VALUES (?, ?, ?, ?, ?)')
+
+    def __init__(self, path: str = DEFAULT_CONTENT_CACHE_PATH, batch_size: int = BATCH_SIZE):
+        super().__init__(path, batch_size)
+
+    def create_tables(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS content_hashes ('
+                          'path TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, '
+                          'mtime INTEGER NOT NULL, digest TEXT NOT NULL, '
+                          'PRIMARY KEY (path, kind)) WITHOUT ROWID')
+
+    def get(self, path: str, stat: os.stat_result, kind: str) -> str:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, digest FROM content_hashes WHERE path = ? AND kind = ?',
+                (os.path.abspath(path), kind)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return row[2]
+
+    def put(self, path: str, stat: os.stat_result, kind: str, digest: str):
+        self.queue((os.path.abspath(path), kind, stat.st_size, stat.st_mtime_ns, digest))
+
+
+class ContentHasher():
+    # Hashes files in a thread pool, hashlib releases the GIL while reading and hashing, and
+    # only the files missing from the cache are read.
+
+    def __init__(self, cache: ContentHashCache, workers: int = DEFAULT_WORKERS):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='hash')
+        self.hashed_files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def hash_files(self, files: list, kind: str) -> dict:
+        # Returns path -> digest of the (path, stat) files, the unreadable ones are left out.
+        digests = {}
+        missing = []
+        for path, stat in files:
+            digest = self.cache.get(path, stat, kind)
+            if digest is None:
+                missing.append((path, stat))
+            else:
+                digests[path] = digest
+
+        def hash_file(path):
+            try:
+                return HASH_FUNCTIONS[kind](path), None
+            except OSError as e:
+                return None, e
+
+        results = self.executor.map(hash_file, [path for path, _ in missing])
+        for (path, stat), (digest, error) in zip(missing, results):
+            self.hashed_files += 1
+            if error is not None:
+                print('Problem:', error, 'with', path)
+                continue
+            self.cache.put(path, stat, kind, digest)
+            digests[path] = digest
+        return digests
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+import errno
+import filecmp
+import json
+import os
+import sys
+from uuid import uuid4
+
+import click
+
+ACTIONS = ('delete', 'hardlink', 'reflink')
+# Outcomes that will not change on a later apply, only these entries are journaled.
+FINAL_STATUSES = ('done', 'already gone', 'already linked')
+# ioctl(dest_fd, FICLONE, src_fd) of linux/fs.h, shares the extents of src with dest.
+FICLONE = 0x40049409
+
+
+@click.group()
+def cli():
+    pass
+
+
+def get_journal_path(plan_path: str) -> str:
+    return '{}.done'.format(plan_path)
+
+
+def read_journal(journal_path: str, plan_id: str) -> set:
+    # Returns the applied line numbers, the first line of the journal is the id of its plan.
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path, 'r') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines or lines[0] != plan_id:
+        print('Ignored {}, it was written for another plan'.format(journal_path))
+        return None
+    return {int(line) for line in lines[1:]}
+
+
+class PlanWriter():
+    # Writes a header with the id of the plan, then one json line per proposed action: the
+    # absolute paths of the duplicate and of the copy it duplicates, and the size and mtime the
+    # duplicate had when planned, so that apply can tell if it changed since.
+
+    def __init__(self, path: str, action: str = 'delete'):
+        if action not in ACTIONS:
+            raise ValueError('Unknown action: {}'.format(action))
+        self.path = path
+        self.action = action
+        self.plan_id = uuid4().hex
+        self.count = 0
+        self.size = 0
+        # The journal of a previous plan at this path does not apply to the new one.
+        if os.path.exists(get_journal_path(path)):
+            os.remove(get_journal_path(path))
+        self.f = open(path, 'w', encoding='utf-8')
+        self.f.write(json.dumps({'plan_id': self.plan_id, 'action': action}) + '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, keep: str, path: str, stat: os.stat_result = None):
+        stat = stat or os.stat(path)
+        # Only a byte identical copy can be linked, the other duplicates are deleted.
+        action = self.action
+        if action != 'delete' and os.path.getsize(keep) != stat.st_size:
+            action = 'delete'
+        entry = {
+            'action': action,
+            'path': os.path.abspath(path),
+            'keep': os.path.abspath(keep),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+        }
+        self.f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.count += 1
+        self.size += stat.st_size
+        print('planned {} {}'.format(action, path))
+
+    def close(self):
+        self.f.close()
+        print('Planned {} actions on {:.2f} MB in {}'.format(self.count, self.size / 1024 / 1024,
+                                                             self.path))
+
+
+def reflink(src: str, dest: str):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    with open(src, 'rb') as src_file, open(dest, 'xb') as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+
+
+def replace_with_link(keep: str, path: str, action: str):
+    # The link is made next to path then renamed over it, so path never goes missing.
+    temp_path = os.path.join(os.path.dirname(path), '.{}.tmp'.format(uuid4().hex))
+    try:
+        if action == 'hardlink':
+            os.link(keep, temp_path)
+        else:
+            reflink(keep, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def apply_entry(entry: dict) -> str:
+    # Returns 'done' or the reason the entry was skipped.
+    path = entry['path']
+    keep = entry['keep']
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 'already gone'
+    if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime']:
+        return 'changed since planned'
+    if not os.path.exists(keep):
+        return 'kept copy {} is gone'.format(keep)
+    if entry['action'] == 'delete':
+        os.remove(path)
+        return 'done'
+    if os.path.samefile(keep, path):
+        return 'already linked'
+    if not filecmp.cmp(keep, path, shallow=False):
+        return 'not identical to {}'.format(keep)
+    replace_with_link(keep, path, entry['action'])
+    return 'done'
+
+
+@cli.command()
+@click.option('--plan_path', required=True, help="Plan written by a run with --plan_path.")
+@click.option('--dry_run', is_flag=True, help="Only print the planned actions.")
+def apply(plan_path, dry_run):
+    """Apply a deduplication plan, resuming where a previous apply stopped."""
+    # Line numbers of the applied entries are appended to the journal as they complete.
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+    plan_id = header.get('plan_id')
+    if plan_id is None:
+        raise click.ClickException('{} has no plan header, plan it again'.format(plan_path))
+    journal_path = get_journal_path(plan_path)
+    done_lines = read_journal(journal_path, plan_id)
+    journal_mode = 'a'
+    if done_lines is None:
+        done_lines = set()
+        journal_mode = 'w'
+    if dry_run:
+        journal_path = os.devnull
+
+    applied = 0
+    skipped = 0
+    failed = 0
+    reclaimed = 0
+    with open(plan_path, 'r', encoding='utf-8') as f, open(journal_path, journal_mode) as journal:
+        if journal.tell() == 0 and not dry_run:
+            journal.write('{}\n'.format(plan_id))
+        for line_number, line in enumerate(f):
+            if line_number == 0 or line_number in done_lines or not line.strip():
+                continue
+            entry = json.loads(line)
+            if dry_run:
+                print('{} {} (keep {})'.format(entry['action'], entry['path'], entry['keep']))
+                continue
+            try:
+                status = apply_entry(entry)
+            except OSError as e:
+                print('Problem:', e, 'with', entry['path'])
+                failed += 1
+                continue
+            if status == 'done':
+                applied += 1
+                reclaimed += entry['size']
+                print('{} {}'.format(entry['action'], entry['path']))
+            else:
+                skipped += 1
+                print('skipped {}: {}'.format(entry['path'], status))
+            if status in FINAL_STATUSES:
+                journal.write('{}\n'.format(line_number))
+                journal.flush()
+    if dry_run:
+        return
+    print('Applied {} actions, {} skipped, {} failed, {:.2f} MB reclaimed'.format(
+        applied, skipped, failed, reclaimed / 1024 / 1024))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,13 +1,28 @@
 #!/usr/bin/python3
 
+import collections
+import contextlib
 import os
-import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 import click
 import imagehash
+import numpy
 from PIL import Image
 
-PIXIV_PATTERN = re.compile(r'\d+_p\d+')
+from dedup_plan import ACTIONS, PlanWriter
+from fs_walker import is_image, is_pixiv_image, walk
+from hamming_index import HammingIndex
+from hash_cache import DEFAULT_HASH_CACHE_PATH, HashCache
+from perceptual_hash import HASH_KINDS, compute_hashes, load_sample
+
+# Images handed to a worker process at a time, and chunks in flight per worker.
+CHUNK_SIZE = 16
+CHUNKS_PER_WORKER = 4
 
 
 @click.group()
@@ -15,17 +30,8 @@ def cli():
     pass
 
 
-def _is_image(filename):
-    f = filename.lower()
-    return f.endswith(".png") or f.endswith(".jpg") or \
-        f.endswith(".jpeg") or f.endswith(".bmp") or \
-        f.endswith(".gif") or '.jpg' in f or  f.endswith(".svg")
-
-
 def _is_pximg(img_path):
-    file_name = os.path.basename(img_path)
-    file_name = file_name.split('.')[0]
-    return bool(PIXIV_PATTERN.match(file_name))
+    return is_pixiv_image(os.path.basename(img_path))
 
 
 def _is_twimg(img_path):
@@ -34,47 +40,395 @@ def _is_twimg(img_path):
     return len(file_name) == 15
 
 
-def _filter(img_list):
+def _remove(img_path, keep_path, protected_paths, plan: PlanWriter = None):
+    if img_path in protected_paths:
+        print('kept {} of a kept directory'.format(img_path))
+        return
+    if plan is not None:
+        plan.add(keep_path, img_path)
+        return
+    os.remove(img_path)
+    print('removed {}'.format(img_path))
+
+
+def _filter(img_list, sizes, protected_paths=(), plan: PlanWriter = None):
+    # sizes holds the size of every image of img_list, as stat'ed during the scan.
     print(' '.join(img_list))
+    pximg_path = None
     pximg_size = None
-    for img_path in img_list:
+    for img_path, size in zip(img_list, sizes):
         if _is_pximg(img_path):
-            pximg_size = os.path.getsize(img_path)
+            pximg_path = img_path
+            pximg_size = size
     if pximg_size:
-        for img_path in img_list:
+        for img_path, size in zip(img_list, sizes):
             if _is_twimg(img_path):
-                if os.path.getsize(img_path) <= pximg_size:
-                    os.remove(img_path)
-                    print('removed {}'.format(img_path))
+                if size <= pximg_size:
+                    _remove(img_path, pximg_path, protected_paths, plan)
     else:
         max_id = 0
         for i in range(len(img_list)):
-            if os.path.getsize(img_list[i]) > os.path.getsize(img_list[max_id]):
+            if sizes[i] > sizes[max_id]:
                 max_id = i
         for i in range(len(img_list)):
             if i != max_id:
-                os.remove(img_list[i])
-                print('removed {}'.format(img_list[i]))
+                _remove(img_list[i], img_list[max_id], protected_paths, plan)
 
 
-@cli.command()
-@click.option('--scan_dir', required=True, help="")
-def run(scan_dir):
-    image_filenames = [
-        os.path.join(scan_dir, path) for path in os.listdir(scan_dir) if _is_image(path)
-    ]
-    images = {}
-    for img in sorted(image_filenames):
+def hash_images(img_list):
+    # Runs in the worker processes, so errors are sent back as text with the path. Every image is
+    # decoded once, then all the hash kinds of the chunk are computed together.
+    results = []
+    samples = []
+    for img in img_list:
         try:
-            hash = imagehash.average_hash(Image.open(img))
+            samples.append(load_sample(img))
+            results.append([img, None, None])
         except Exception as e:
-            print('Problem:', e, 'with', img)
+            results.append([img, None, str(e)])
+    hashes = iter(compute_hashes(samples).tolist()) if samples else iter(())
+    for result in results:
+        if result[2] is None:
+            result[1] = tuple(next(hashes))
+    return [tuple(result) for result in results]
+
+
+def iter_hashes(img_list, workers: int = 1, chunk_size: int = CHUNK_SIZE):
+    # Yields (img, hashes, error) in the order of img_list whatever the number of workers. A
+    # window of a few chunks per worker is kept in flight, a new chunk being submitted as soon as
+    # the oldest one is yielded, so the workers never wait for the slowest chunk of a batch.
+    it = iter(img_list)
+    chunks = iter(lambda: list(islice(it, chunk_size)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield from hash_images(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(
+            executor.submit(hash_images, chunk)
+            for chunk in islice(chunks, workers * CHUNKS_PER_WORKER))
+        while pending:
+            results = pending.popleft().result()
+            for chunk in islice(chunks, 1):
+                pending.append(executor.submit(hash_images, chunk))
+            yield from results
+
+
+def get_hashes(roots: list, hash_cache: HashCache, workers: int = 1, exclude=()):
+    # Returns the paths of the images under roots in scan order, their sizes and a
+    # (N, len(HASH_KINDS)) uint64 array of their hashes. Only the new or modified images are
+    # decoded, and the walk goes on while they are hashed, so only the images in flight are held
+    # besides the results.
+    img_list = []
+    sizes = []
+    hashes = []
+    pending = collections.deque()
+    seen_paths = set()
+
+    def iter_uncached():
+        for entry in walk(roots, is_image, exclude=exclude):
+            img = entry.path
+            stat = entry.stat()
+            # Nested or repeated roots must not make an image a duplicate of itself.
+            if os.path.abspath(img) in seen_paths:
+                continue
+            seen_paths.add(os.path.abspath(img))
+            cached = hash_cache.get(img, stat)
+            img_list.append(img)
+            sizes.append(stat.st_size)
+            hashes.append(cached)
+            if cached is None:
+                pending.append((len(img_list) - 1, stat))
+                yield img
+
+    decoded_count = 0
+    for img, hash, error in iter_hashes(iter_uncached(), workers):
+        position, stat = pending.popleft()
+        decoded_count += 1
+        if error is not None:
+            print('Problem:', error, 'with', img)
             continue
-        images[hash] = images.get(hash, []) + [img]
+        hash_cache.put(img, stat, hash)
+        hashes[position] = hash
+
+    # The cached hashes of excluded images are kept for the runs that do not exclude them.
+    removed = 0 if exclude else sum(hash_cache.prune(root, seen_paths) for root in roots)
+    cached_count = len(img_list) - decoded_count
+    print('Decoded {} new or modified images, {} hashes from the cache, {} evicted'.format(
+        decoded_count, cached_count, removed))
+
+    hashed = [i for i, hash in enumerate(hashes) if hash is not None]
+    values = numpy.array([hashes[i] for i in hashed], dtype=numpy.uint64)
+    return ([img_list[i] for i in hashed], [sizes[i] for i in hashed],
+            values.reshape(-1, len(HASH_KINDS)))
+
+
+def iter_matches(indexes: list, values: numpy.ndarray, votes: int):
+    # Yields (i, positions) of the rows of values matching indexed rows in at least votes of the
+    # hash kinds, every index answering the queries of one column of values.
+    for i, row in enumerate(values.tolist()):
+        kind_matches = collections.Counter()
+        for index, value in zip(indexes, row):
+            kind_matches.update(position for position, _ in index.query(value))
+        yield i, [position for position, count in kind_matches.items() if count >= votes]
+
+
+def _link(links: dict, a: int, b: int):
+    if a != b:
+        links.setdefault(a, set()).add(b)
+        links.setdefault(b, set()).add(a)
+
+
+def _group(links: dict) -> list:
+    # Nodes are taken in order and join the first group of a linked node whose every member they
+    # match. Every image of a group is within the threshold of all the others, a chain of similar
+    # images, such as the pages of a comic, is not merged into one group.
+    groups = []
+    group_of = {}
+    for node in sorted(links):
+        group = None
+        for other in sorted(links[node]):
+            if other in group_of and links[node].issuperset(groups[group_of[other]]):
+                group = group_of[other]
+                break
+        if group is None:
+            group = len(groups)
+            groups.append([])
+        groups[group].append(node)
+        group_of[node] = group
+    return [nodes for nodes in groups if len(nodes) > 1]
+
+
+@cli.command()
+@click.option('--scan_dir',
+              'scan_dirs',
+              required=True,
+              multiple=True,
+              help="Directory scanned recursively, can be repeated.")
+@click.option('--keep_dir',
+              'keep_dirs',
+              multiple=True,
+              help="Directory scanned recursively whose images are never removed, can be repeated.")
+@click.option('--exclude',
+              multiple=True,
+              help="Glob of file or directory names or paths to skip, can be repeated.")
+@click.option('--threshold',
+              default=0,
+              help="Maximum number of different bits of a hash kind for it to match.")
+@click.option('--hashes',
+              'hash_kinds',
+              default=','.join(HASH_KINDS),
+              help="Comma separated hash kinds to compare, among {}.".format(', '.join(HASH_KINDS)))
+@click.option('--votes',
+              default=2,
+              help="Number of hash kinds that must match for images to be duplicated.")
+@click.option('--archive_dir',
+              default=None,
+              help="Compare with the cached hashes of this directory instead of scanning it, "
+              "its images are never removed.")
+@click.option('--workers', default=os.cpu_count() or 1, help="Number of hashing processes.")
+@click.option('--hash_cache_path',
+              default=DEFAULT_HASH_CACHE_PATH,
+              help="Path of the sqlite cache of image hashes.")
+@click.option('--plan_path',
+              default=None,
+              help="Write the removals to this plan for dedup_plan.py apply instead of removing.")
+@click.option('--action',
+              type=click.Choice(ACTIONS),
+              default='delete',
+              help="Planned action, duplicates of a different size are always deleted.")
+def run(scan_dirs, keep_dirs, exclude, threshold, hash_kinds, votes, archive_dir, workers,
+        hash_cache_path, plan_path, action):
+    if action != 'delete' and not plan_path:
+        raise click.BadParameter('{} needs --plan_path'.format(action), param_hint='--action')
+    hash_kinds = hash_kinds.split(',')
+    for kind in hash_kinds:
+        if kind not in HASH_KINDS:
+            raise click.BadParameter('Unknown hash kind: {}'.format(kind), param_hint='--hashes')
+    columns = [HASH_KINDS.index(kind) for kind in hash_kinds]
+    votes = min(votes, len(columns))
+
+    with HashCache(hash_cache_path) as hash_cache:
+        img_list, sizes, values = get_hashes(
+            list(scan_dirs) + list(keep_dirs), hash_cache, workers, exclude)
+        archive_hashes = list(hash_cache.iter_root(archive_dir)) if archive_dir else []
+    values = values[:, columns]
+    keep_prefixes = tuple(os.path.join(os.path.abspath(keep_dir), '') for keep_dir in keep_dirs)
+    protected_paths = {img for img in img_list if os.path.abspath(img).startswith(keep_prefixes)}
+
+    # Images are linked to every image matching them.
+    links = {}
+    indexes = [HammingIndex(values[:, column], threshold) for column in range(len(columns))]
+    for i, positions in iter_matches(indexes, values, votes):
+        for j in positions:
+            _link(links, i, j)
+
+    if archive_hashes:
+        # Only the groups of newly arrived images matter, the archive is not compared with itself.
+        scanned_paths = {os.path.abspath(img) for img in img_list}
+        archive_hashes = [(img, hash) for img, hash in archive_hashes if img not in scanned_paths]
+        archive_values = numpy.array([hash for _, hash in archive_hashes], dtype=numpy.uint64)
+        archive_values = archive_values.reshape(-1, len(HASH_KINDS))[:, columns]
+        archive_indexes = [
+            HammingIndex(archive_values[:, column], threshold) for column in range(len(columns))
+        ]
+        archive_nodes = {}
+        for i, positions in iter_matches(archive_indexes, values, votes):
+            for k in positions:
+                img = archive_hashes[k][0]
+                if k not in archive_nodes:
+                    archive_nodes[k] = None
+                    if os.path.exists(img):
+                        archive_nodes[k] = len(img_list)
+                        img_list.append(img)
+                        sizes.append(os.path.getsize(img))
+                        protected_paths.add(img)
+                if archive_nodes[k] is not None:
+                    _link(links, i, archive_nodes[k])
+        print('Compared with {} cached hashes of {}'.format(len(archive_hashes), archive_dir))
+
+    # Only the linked images are grouped, the others have no duplicate.
+    with PlanWriter(plan_path, action) if plan_path else contextlib.nullcontext() as plan:
+        for nodes in _group(links):
+            _filter([img_list[node] for node in nodes], [sizes[node] for node in nodes],
+                    protected_paths, plan)
+
+
+@cli.command()
+@click.option('--scan_dir',
+              'scan_dirs',
+              required=True,
+              multiple=True,
+              help="Directory scanned recursively, can be repeated.")
+@click.option('--exclude',
+              multiple=True,
+              help="Glob of file or directory names or paths to skip, can be repeated.")
+@click.option('--workers', default=os.cpu_count() or 1, help="Number of hashing processes.")
+@click.option('--hash_cache_path',
+              default=DEFAULT_HASH_CACHE_PATH,
+              help="Path of the sqlite cache of image hashes.")
+def index(scan_dirs, exclude, workers, hash_cache_path):
+    """Hash the images of directories into the cache without removing anything."""
+    with HashCache(hash_cache_path) as hash_cache:
+        get_hashes(list(scan_dirs), hash_cache, workers, exclude)
+
+
+def generate_corpus(corpus_dir: str, count: int, size: int):
+    # Smooth random images that survive JPEG encoding with distinct hashes.
+    rng = numpy.random.default_rng(0)
+    img_list = []
+    for i in range(count):
+        small = rng.integers(0, 256, (8, 8, 3), dtype=numpy.uint8)
+        img = Image.fromarray(small).resize((size, size), Image.BICUBIC)
+        # One image in four is a png, to cover the non JPEG decode path.
+        extension = 'png' if i % 4 == 3 else 'jpg'
+        img_path = os.path.join(corpus_dir, '{:06d}.{}'.format(i, extension))
+        img.save(img_path, quality=90)
+        img_list.append(img_path)
+    return img_list
+
+
+@cli.command()
+@click.option('--count', default=200, help="Number of generated images.")
+@click.option('--size', default=2000, help="Width and height of the generated images.")
+@click.option('--workers', default='1,2,4,8', help="Comma separated worker counts to compare.")
+def benchmark_hashing(count, size, workers):
+    """Hash a generated corpus with several worker counts."""
+    corpus_dir = tempfile.mkdtemp(prefix='dedup_benchmark_')
+    try:
+        img_list = generate_corpus(corpus_dir, count, size)
+        baseline = None
+        baseline_elapsed = None
+        for worker_count in [int(w) for w in workers.split(',')]:
+            start_time = time.perf_counter()
+            results = list(iter_hashes(img_list, worker_count))
+            elapsed = time.perf_counter() - start_time
+            baseline = baseline or results
+            baseline_elapsed = baseline_elapsed or elapsed
+            print('{:>3} workers: {:.2f}s, {:.1f} images/s, speedup {:.2f}x, {}'.format(
+                worker_count, elapsed, count / elapsed, baseline_elapsed / elapsed,
+                'same hashes' if results == baseline else 'DIFFERENT HASHES'))
+    finally:
+        shutil.rmtree(corpus_dir)
+
+
+@cli.command()
+@click.option('--sizes',
+              default='10000,100000,1000000',
+              help="Comma separated numbers of indexed hashes.")
+@click.option('--threshold', default=4, help="Hamming radius of the queries.")
+@click.option('--queries', default=1000, help="Number of queries per size.")
+def benchmark_index(sizes, threshold, queries):
+    """Measure the Hamming index build and query cost as it grows."""
+    rng = numpy.random.default_rng(0)
+    for size in [int(s) for s in sizes.split(',')]:
+        values = rng.integers(0, 2**64, size, dtype=numpy.uint64, endpoint=False)
+        start_time = time.perf_counter()
+        index = HammingIndex(values, threshold)
+        build_elapsed = time.perf_counter() - start_time
+
+        # Half of the queries are near duplicates of indexed hashes, the others random.
+        flips = rng.integers(0, 64, (queries, threshold), dtype=numpy.uint64)
+        near = values[rng.integers(0, size, queries)]
+        for column in range(threshold):
+            near = near ^ (numpy.uint64(1) << flips[:, column])
+        random_values = rng.integers(0, 2**64, queries, dtype=numpy.uint64)
+        targets = numpy.where(numpy.arange(queries) % 2 == 0, near, random_values)
+        start_time = time.perf_counter()
+        matches = sum(len(index.query(value)) for value in targets.tolist())
+        query_elapsed = time.perf_counter() - start_time
+        candidates = sum(len(index.candidates(value)) for value in targets.tolist())
+        print('{:>9} hashes: build {:.2f}s, {:.1f}us/query, {:.1f} candidates/query, '
+              '{} matches'.format(size, build_elapsed, query_elapsed / queries * 1e6,
+                                  candidates / queries, matches))
+
+
+@cli.command()
+@click.option('--scan_dir', default=None, help="Images to measure, a corpus is generated if unset.")
+@click.option('--count', default=100, help="Number of generated images.")
+@click.option('--size', default=3000, help="Width and height of the generated images.")
+def benchmark_decode(scan_dir, count, size):
+    """Compare the single reduced decode used for hashing with imagehash on full decodes."""
+    reference_functions = [imagehash.average_hash, imagehash.dhash, imagehash.phash]
+    corpus_dir = None
+    if scan_dir:
+        img_list = [entry.path for entry in walk([scan_dir], is_image)]
+    else:
+        corpus_dir = tempfile.mkdtemp(prefix='dedup_benchmark_')
+    try:
+        if corpus_dir:
+            img_list = generate_corpus(corpus_dir, count, size)
+
+        # One full decode per hash kind, as calling the imagehash functions one by one does.
+        references = {}
+        start_time = time.perf_counter()
+        for img in img_list:
+            try:
+                references[img] = [
+                    int(str(function(Image.open(img))), 16) for function in reference_functions
+                ]
+            except Exception as e:
+                print('Problem:', e, 'with', img)
+        elapsed = time.perf_counter() - start_time
+        print('imagehash: {:.2f}s, {:.1f} images/s'.format(elapsed, len(img_list) / elapsed))
+
+        start_time = time.perf_counter()
+        results = list(iter_hashes(img_list))
+        elapsed = time.perf_counter() - start_time
+        print(' pipeline: {:.2f}s, {:.1f} images/s'.format(elapsed, len(img_list) / elapsed))
+    finally:
+        if corpus_dir:
+            shutil.rmtree(corpus_dir)
 
-    for img_list in images.values():
-        if len(img_list) > 1:
-            _filter(img_list)
+    # Accuracy: bits differing from the imagehash result, image count per distance and kind.
+    for column, kind in enumerate(HASH_KINDS):
+        distances = collections.Counter(
+            bin(hashes[column] ^ references[img][column]).count('1')
+            for img, hashes, error in results
+            if error is None and img in references)
+        print('{}: {}'.format(
+            kind, ', '.join('{} bits: {}'.format(distance, distances[distance])
+                            for distance in sorted(distances))))
 
 
 if __name__ == "__main__":
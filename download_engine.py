@@ -0,0 +1,304 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CONCURRENCY = 8
+# Downloads queued per worker before submit() blocks the producer.
+QUEUE_DEPTH_PER_WORKER = 4
+CHUNK_SIZE = 256 * 1024
+# Read size of resumable downloads, a chunk still being read when the connection drops is lost.
+PART_CHUNK_SIZE = 16 * 1024
+TIMEOUT = 60
+# Attempts of one download, each resuming from what the previous ones left in the .part file.
+DOWNLOAD_ATTEMPTS = 3
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)')
+
+# Upper bound of simultaneous transfers per image host, whatever the global concurrency is.
+HOST_CONCURRENCY = {
+    'pbs.twimg.com': 8,
+    'i.pximg.net': 4,
+}
+
+
+def get_proxies():
+    proxies = {}
+    https_proxy = os.environ.get("HTTPS_PROXY")
+    if https_proxy:
+        proxies["https"] = https_proxy
+    return proxies
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownloadError(DownloadError):
+    pass
+
+
+class MissingFileError(DownloadError):
+    # The server says the file is gone for good, as opposed to a transient failure.
+    pass
+
+
+# Statuses meaning the file does not exist anymore, any other failure may be retried later.
+MISSING_STATUS_CODES = (404, 410)
+
+
+def parse_content_range(content_range: str):
+    # Returns (first byte or None, total size or None) of a Content-Range header.
+    match = CONTENT_RANGE_PATTERN.match(content_range or '')
+    if not match:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start else None), (int(total) if total != '*' else None)
+
+
+def create_session(pool_maxsize: int, pool_connections: int = 1) -> requests.Session:
+    # One keep-alive pool per host, large enough for every worker.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.proxies.update(get_proxies())
+    return session
+
+
+def probe_size(session: requests.Session, url: str, headers: dict = None) -> int:
+    # Reads the size of the remote file without its body: a HEAD first, then a one byte Range
+    # GET for servers that reject HEAD or leave out Content-Length.
+    r = session.head(url, headers=headers, timeout=TIMEOUT, allow_redirects=True)
+    if r.status_code in MISSING_STATUS_CODES:
+        raise MissingFileError('{} returned status code {}'.format(url, r.status_code))
+    content_length = r.headers.get('Content-Length')
+    if r.status_code == 200 and content_length and not r.headers.get('Content-Encoding'):
+        return int(content_length)
+
+    request_headers = dict(headers or {})
+    request_headers['Range'] = 'bytes=0-0'
+    with session.get(url, headers=request_headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 206:
+            _, total = parse_content_range(r.headers.get('Content-Range'))
+            if total is not None:
+                return total
+        elif r.status_code in MISSING_STATUS_CODES:
+            raise MissingFileError('{} returned status code {}'.format(url, r.status_code))
+        elif r.status_code != 200:
+            raise DownloadError('{} returned status code {}'.format(url, r.status_code))
+        # The range was ignored, so the size has to come from the full body.
+        content_length = r.headers.get('Content-Length')
+        if content_length and not r.headers.get('Content-Encoding'):
+            return int(content_length)
+        return sum(len(chunk) for chunk in r.iter_content(CHUNK_SIZE))
+
+
+def download_to_part(session: requests.Session,
+                     url: str,
+                     part_path: str,
+                     headers: dict = None) -> int:
+    # Appends to what an earlier attempt left in part_path with a Range request, and falls back
+    # to a full download when the server ignores or rejects the range.
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request_headers = dict(headers or {})
+    if offset:
+        request_headers['Range'] = 'bytes={}-'.format(offset)
+    with session.get(url, headers=request_headers, stream=True, timeout=TIMEOUT) as r:
+        if offset and r.status_code == 416:
+            _, total = parse_content_range(r.headers.get('Content-Range'))
+            if total == offset:
+                return offset
+            os.remove(part_path)
+            return download_to_part(session, url, part_path, headers)
+        if offset and r.status_code == 206:
+            start, total = parse_content_range(r.headers.get('Content-Range'))
+            if start != offset:
+                os.remove(part_path)
+                return download_to_part(session, url, part_path, headers)
+            expected_size = total
+        elif r.status_code == 200:
+            offset = 0
+            expected_size = r.headers.get('Content-Length')
+            expected_size = int(expected_size) if expected_size is not None else None
+        else:
+            raise DownloadError('{} returned status code {}'.format(url, r.status_code))
+        if r.headers.get('Content-Encoding'):
+            expected_size = None
+
+        size = offset
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(PART_CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+    if expected_size is not None and expected_size != size:
+        raise IncompleteDownloadError('{} truncated: got {} of {} bytes'.format(
+            url, size, expected_size))
+    if size == 0:
+        os.remove(part_path)
+        raise DownloadError('{} returned an empty body'.format(url))
+    return size
+
+
+def get_part_path(output_path: str) -> str:
+    return '{}.part'.format(output_path)
+
+
+def complete_part(session: requests.Session, url: str, part_path: str, headers: dict = None) -> int:
+    # Resumes part_path until it holds the whole body, retrying dropped connections and
+    # truncated bodies. What was received is kept on failure, for the next run to resume.
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            return download_to_part(session, url, part_path, headers)
+        except (IncompleteDownloadError, requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            if attempt + 1 == DOWNLOAD_ATTEMPTS:
+                raise
+            logging.warning('Resuming {} after: {}'.format(url, e))
+
+
+def download_to_file(session: requests.Session,
+                     url: str,
+                     output_path: str,
+                     headers: dict = None) -> int:
+    # The body is collected in '<output_path>.part' and only renamed to output_path once it is
+    # complete, so an interrupted run leaves a .part to resume instead of a truncated image.
+    part_path = get_part_path(output_path)
+    size = complete_part(session, url, part_path, headers)
+    os.replace(part_path, output_path)
+    return size
+
+
+class DownloadJob():
+    # Groups the downloads of one job sharing an engine with others, with an optional limit of
+    # its own on the downloads it has queued or running.
+
+    def __init__(self, name: str = '', concurrency: int = None):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.submitted_files = 0
+        self.downloaded_files = 0
+        self.downloaded_bytes = 0
+        self.failed_files = 0
+
+    def join(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+
+class DownloadEngine():
+
+    def __init__(self,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 host_concurrency: dict = None,
+                 queue_depth: int = None):
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = queue_depth or self.concurrency * QUEUE_DEPTH_PER_WORKER
+        self.host_concurrency = HOST_CONCURRENCY | (host_concurrency or {})
+
+        self.session = create_session(self.concurrency, len(self.host_concurrency) + 1)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix='download')
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        # Bounds the number of queued and running downloads, so that a producer paginating
+        # faster than the downloads finish is throttled instead of growing the queue.
+        self.queue_slots = threading.BoundedSemaphore(self.queue_depth)
+        self.futures = set()
+        self.submitted_paths = set()
+
+        self.start_time = time.monotonic()
+        self.downloaded_files = 0
+        self.downloaded_bytes = 0
+        self.failed_files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).hostname or ''
+        with self.lock:
+            if host not in self.host_semaphores:
+                limit = min(self.host_concurrency.get(host, self.concurrency), self.concurrency)
+                self.host_semaphores[host] = threading.BoundedSemaphore(limit)
+            return self.host_semaphores[host]
+
+    def submit(self, url: str, output_path: str, headers: dict = None, job: DownloadJob = None):
+        with self.lock:
+            already_submitted = output_path in self.submitted_paths
+            self.submitted_paths.add(output_path)
+        if already_submitted or os.path.exists(output_path):
+            logging.warning('{} already exists, skip.'.format(output_path))
+            return None
+        if job and job.slots:
+            job.slots.acquire()
+        self.queue_slots.acquire()
+        print('Downloading image {} to {}'.format(url, output_path))
+        logging.info('Downloading image {} to {}'.format(url, output_path))
+        future = self.executor.submit(self._download, url, output_path, headers, job)
+        with self.lock:
+            self.futures.add(future)
+        if job:
+            with job.lock:
+                job.futures.add(future)
+                job.submitted_files += 1
+        future.add_done_callback(lambda future: self._on_done(future, job))
+        return future
+
+    def _on_done(self, future, job: DownloadJob = None):
+        with self.lock:
+            self.futures.discard(future)
+        self.queue_slots.release()
+        if job:
+            with job.lock:
+                job.futures.discard(future)
+            if job.slots:
+                job.slots.release()
+
+    def _download(self, url: str, output_path: str, headers: dict = None, job: DownloadJob = None):
+        try:
+            with self.get_host_semaphore(url):
+                size = download_to_file(self.session, url, output_path, headers)
+        except Exception as e:
+            logging.error('Failed to download {}: {}'.format(url, e))
+            for stats in filter(None, [self, job]):
+                with stats.lock:
+                    stats.failed_files += 1
+            return
+        for stats in filter(None, [self, job]):
+            with stats.lock:
+                stats.downloaded_files += 1
+                stats.downloaded_bytes += size
+
+    def join(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        megabytes = self.downloaded_bytes / 1024 / 1024
+        return ('Downloaded {} files ({:.2f} MB) in {:.1f}s, {:.2f} files/s, {:.2f} MB/s, '
+                '{} failed').format(self.downloaded_files, megabytes, elapsed,
+                                    self.downloaded_files / elapsed, megabytes / elapsed,
+                                    self.failed_files)
+
+    def close(self):
+        self.join()
+        self.executor.shutdown()
+        self.session.close()
+        summary = self.summary()
+        print(summary)
+        logging.info(summary)
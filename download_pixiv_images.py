@@ -5,7 +5,20 @@ import json
 import logging
 import os
 import pixivpy3
-import requests
+import threading
+
+import pixiv_auth
+from download_engine import DEFAULT_CONCURRENCY, DownloadEngine, DownloadJob
+from fs_index import DEFAULT_INDEX_DIR, get_file_names
+from pixiv_token import DEFAULT_TOKEN_CACHE_PATH, TokenCache
+from processed_store import DEFAULT_STORE_PATH, ProcessedStore
+
+PIXIV_HEADERS = {
+    'Referer':
+        'https://www.pixiv.net/',
+    'User-Agent':
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36'
+}
 
 
 @click.group()
@@ -13,50 +26,109 @@ def cli():
     pass
 
 
-def get_proxies():
-    proxies = {}
-    https_proxy = os.environ.get("HTTPS_PROXY")
-    if https_proxy:
-        proxies["https"] = https_proxy
-    return proxies
-
-
 def get_refresh_token():
     refresh_token = os.environ.get('PIXIV_REFRESH_TOKEN')
     assert refresh_token
     return refresh_token
 
 
-def get_api():
-    api = pixivpy3.ByPassSniApi()
-    api.require_appapi_hosts(hostname='210.140.131.223')
+def is_invalid_token(response) -> bool:
+    # Pixiv rejects an expired access token with a 400 OAuth error as often as with a 401.
+    return response.status_code == 401 or \
+        (response.status_code == 400 and 'invalid_grant' in response.text)
+
+
+class PixivApi(pixivpy3.ByPassSniApi):
+    # Reuses the access token of the token cache until shortly before it expires, and refreshes
+    # it once when a request is rejected for an expired or invalid token.
+
+    # Concurrent jobs of a batch share the cache, only one of them refreshes the token.
+    auth_lock = threading.Lock()
+
+    def __init__(self,
+                 refresh_token: str,
+                 token_cache_path: str = DEFAULT_TOKEN_CACHE_PATH,
+                 auth_token_url: str = None,
+                 **requests_kwargs):
+        super().__init__(**requests_kwargs)
+        self.token_cache = TokenCache(token_cache_path)
+        # The token endpoint of pixiv_auth or a stand-in, instead of pixivpy3's own auth.
+        self.auth_token_url = auth_token_url
+        self.refresh_token = refresh_token
+
+    def request_token(self) -> dict:
+        if self.auth_token_url is None:
+            return self.auth(refresh_token=self.refresh_token)
+        response = pixiv_auth.request_token(self.refresh_token, self.auth_token_url)
+        if response.status_code != 200:
+            raise pixivpy3.PixivError('auth() failed! HTTP {}: {}'.format(
+                response.status_code, response.text))
+        return response.json()
+
+    def authorize(self, rejected_token: str = None):
+        with self.auth_lock:
+            access_token = self.token_cache.get(self.refresh_token)
+            if access_token is None or access_token == rejected_token:
+                try:
+                    token = self.request_token()
+                except Exception:
+                    # The rejected token must not be reused by the next run either.
+                    if rejected_token is not None:
+                        self.token_cache.invalidate(self.refresh_token)
+                    raise
+                access_token = token['access_token']
+                self.token_cache.put(self.refresh_token, access_token, token['expires_in'])
+                logging.info('Refreshed the Pixiv access token')
+            self.set_auth(access_token, self.refresh_token)
+
+    def no_auth_requests_call(self,
+                              method,
+                              url,
+                              headers=None,
+                              params=None,
+                              data=None,
+                              req_auth=True):
+        if req_auth and self.access_token is None:
+            self.authorize()
+        response = super().no_auth_requests_call(method, url, headers, params, data, req_auth)
+        if req_auth and is_invalid_token(response):
+            logging.info('Pixiv rejected the access token, refresh it and retry')
+            self.authorize(rejected_token=self.access_token)
+            response = super().no_auth_requests_call(method, url, headers, params, data, req_auth)
+        return response
+
+
+def get_api(token_cache_path: str = DEFAULT_TOKEN_CACHE_PATH):
+    # PIXIV_AUTH_TOKEN_URL points the token refresh at another OAuth endpoint, such as a local
+    # stand-in.
+    auth_token_url = os.environ.get('PIXIV_AUTH_TOKEN_URL')
+    api = PixivApi(get_refresh_token(), token_cache_path, auth_token_url)
+    if os.environ.get('PIXIV_API_HOSTS'):
+        api.set_api_proxy(os.environ['PIXIV_API_HOSTS'])
+    else:
+        api.require_appapi_hosts(hostname='210.140.131.223')
     api.set_accept_language("en-us")
-    api.auth(refresh_token=get_refresh_token())
     return api
 
 
 def get_user_bookmarks_illust(api, user_id):
-    result = []
     page_result = api.user_bookmarks_illust(user_id, restrict="public")
-    result.extend(page_result['illusts'])
+    yield from page_result['illusts']
     while page_result['next_url']:
         next_qs = api.parse_qs(page_result['next_url'])
         assert next_qs
         page_result = api.user_bookmarks_illust(**next_qs)
-        result.extend(page_result['illusts'])
-    return result
+        yield from page_result['illusts']
 
 
 def get_user_illust(api, user_id):
-    result = []
     page_result = api.user_illusts(user_id, type="illust")
-    result.extend(page_result['illusts'])
+    yield from page_result['illusts']
     while page_result['next_url']:
         next_qs = api.parse_qs(page_result['next_url'])
         assert next_qs
         page_result = api.user_illusts(**next_qs)
-        result.extend(page_result['illusts'])
-    return result
+        yield from page_result['illusts']
 
 
 def get_image_urls_from_illust(illust):
@@ -68,113 +140,110 @@ def get_image_urls_from_illust(illust):
         return [meta_page['image_urls']['original'] for meta_page in illust['meta_pages']]
 
 
-def read_prossesed_ids(username: str):
-    processed_ids = set()
-    filename = '{}.processed_ids'.format(username)
-    if not os.path.exists(filename):
-        logging.error('{} not exists, will download all images.'.format(filename))
-        return processed_ids
-    with open(filename, 'r') as f:
-        for processed_id in f:
-            processed_ids.add(processed_id.rstrip('\r\n'))
-    return processed_ids
+def download_image(engine: DownloadEngine,
+                   output_dir: str,
+                   image_url: str,
+                   job: DownloadJob = None):
+    filename = image_url.split('/')[-1]
+    output_path = os.path.join(output_dir, filename)
+    engine.submit(image_url, output_path, headers=PIXIV_HEADERS, job=job)
 
 
-def write_processed_id(username: str, processed_id: int):
-    filename = '{}.processed_ids'.format(username)
-    with open(filename, 'a') as f:
-        f.write('{}\n'.format(str(processed_id)))
+def is_existed_image(file_name: str) -> bool:
+    splits = file_name.split('.')
+    return len(splits) == 2 and splits[1] in ['jpg', 'png'] and '_p' in splits[0]
 
 
-def download_image(output_dir: str, image_url: str):
-    filename = image_url.split('/')[-1]
-    output_path = os.path.join(output_dir, filename)
-    if os.path.exists(output_path):
-        logging.warning('{} already exists, skip.'.format(output_path))
-        return
-    print('Downloading image {} to {}'.format(image_url, output_path))
-    logging.info('Downloading image {} to {}'.format(image_url, output_path))
-    r = requests.get(
-        image_url,
-        proxies=get_proxies(),
-        headers={
-            'Referer':
-                'https://www.pixiv.net/',
-            'User-Agent':
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36'
-        })
-    with open(output_path, "wb") as f:
-        f.write(r.content)
-
-
-def get_existed_images(scan_dir: str):
-    existed_images = set()
-    for file_name in os.listdir(scan_dir):
-        file_path = os.path.join(scan_dir, file_name)
-        if os.path.isdir(file_path):
-            existed_images = existed_images | get_existed_images(file_path)
-        else:
-            splits = file_name.split('.')
-            if len(splits) == 2 and splits[1] in ['jpg', 'png'] and '_p' in splits[0]:
-                existed_images.add(file_name)
-    return existed_images
+def get_existed_images(scan_dirs: str, index_dir: str, root_cache: dict = None):
+    return get_file_names(scan_dirs.split(','), is_existed_image, index_dir, root_cache)
 
 
 @cli.command()
 @click.option('--user_id', required=True, help="")
 @click.option('--output_dir', default='./output/', help="")
 @click.option('--scan_dirs', default='./', help="")
+@click.option('--index_dir',
+              default=DEFAULT_INDEX_DIR,
+              help="Directory of the persistent file name index of scan_dirs.")
+@click.option('--concurrency',
+              default=DEFAULT_CONCURRENCY,
+              help="Max number of images downloaded at the same time.")
+@click.option('--processed_store_path',
+              default=DEFAULT_STORE_PATH,
+              help="Path to the sqlite store of processed image ids.")
+@click.option('--token_cache_path',
+              default=DEFAULT_TOKEN_CACHE_PATH,
+              help="Path of the cached Pixiv access token.")
 @click.option('--log_path',
               default='./download_user_bookmarks_images.log',
               help="Path to output logging's log.")
-def download_user_bookmarks_images(user_id, output_dir, scan_dirs, log_path):
+def download_user_bookmarks_images(user_id, output_dir, scan_dirs, index_dir, concurrency,
+                                   processed_store_path, token_cache_path, log_path):
     logging.basicConfig(filename=log_path, format='%(asctime)s - %(message)s', level=logging.INFO)
     os.makedirs(output_dir, exist_ok=True)
 
-    processed_ids = read_prossesed_ids(user_id)
-    logging.info('Processed ids num: {}'.format(len(processed_ids)))
+    processed_store = ProcessedStore(processed_store_path)
+    processed_store.import_text_file(user_id, '{}.processed_ids'.format(user_id))
+    logging.info('Processed ids num: {}'.format(processed_store.count(user_id)))
 
-    existed_images = set()
-    for scan_dir in scan_dirs.split(','):
-        existed_images = existed_images | get_existed_images(scan_dir)
+    existed_images = get_existed_images(scan_dirs, index_dir)
     logging.info('existed images num: {}'.format(len(existed_images)))
 
-    image_urls = []
+    api = get_api(token_cache_path)
+    with processed_store, DownloadEngine(concurrency) as engine:
+        download_bookmarks_images(api, engine, processed_store, user_id, output_dir, existed_images)
+
 
-    api = get_api()
-    illusts = get_user_bookmarks_illust(api, user_id)
-    for illust in illusts:
+def download_bookmarks_images(api,
+                              engine: DownloadEngine,
+                              processed_store: ProcessedStore,
+                              user_id: str,
+                              output_dir: str,
+                              existed_images: set,
+                              job: DownloadJob = None):
+    for illust in get_user_bookmarks_illust(api, user_id):
         urls = get_image_urls_from_illust(illust)
         for url in urls:
             image_file_name = url.split('/')[-1]
             image_id = image_file_name.split('.')[0]
-            if image_id in processed_ids:
+            if processed_store.contains(user_id, image_id):
                 continue
-            write_processed_id(user_id, image_id)
+            processed_store.add(user_id, image_id)
             if image_file_name in existed_images:
                 continue
-            image_urls.append(url)
-
-    for image_url in image_urls:
-        download_image(output_dir, image_url)
+            download_image(engine, output_dir, url, job)
 
 
 @cli.command()
 @click.option('--user_id', required=True, help="")
 @click.option('--output_dir', default='./output/', help="")
+@click.option('--concurrency',
+              default=DEFAULT_CONCURRENCY,
+              help="Max number of images downloaded at the same time.")
+@click.option('--token_cache_path',
+              default=DEFAULT_TOKEN_CACHE_PATH,
+              help="Path of the cached Pixiv access token.")
 @click.option('--log_path',
               default='./download_user_images.log',
               help="Path to output logging's log.")
-def download_user_images(user_id, output_dir, log_path):
+def download_user_images(user_id, output_dir, concurrency, token_cache_path, log_path):
     logging.basicConfig(filename=log_path, format='%(asctime)s - %(message)s', level=logging.INFO)
     os.makedirs(output_dir, exist_ok=True)
 
-    api = get_api()
-    illusts = get_user_illust(api, user_id)
-    for illust in illusts:
+    api = get_api(token_cache_path)
+    with DownloadEngine(concurrency) as engine:
+        download_illust_images(api, engine, user_id, output_dir)
+
+
+def download_illust_images(api,
+                           engine: DownloadEngine,
+                           user_id: str,
+                           output_dir: str,
+                           job: DownloadJob = None):
+    for illust in get_user_illust(api, user_id):
         urls = get_image_urls_from_illust(illust)
         for url in urls:
-            download_image(output_dir, url)
+            download_image(engine, output_dir, url, job)
 
 
 if __name__ == "__main__":
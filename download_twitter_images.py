@@ -6,44 +6,30 @@ import logging
 import os
 import time
 from collections import deque
+from urllib.parse import urlparse
 
-import requests
-
+from download_engine import DEFAULT_CONCURRENCY, DownloadEngine, DownloadJob
+from fs_index import DEFAULT_INDEX_DIR, get_file_names
 from graphql_api import GraphqlAPI
 from login import login
+from processed_store import DEFAULT_STORE_PATH, ProcessedStore
+from tweet_extractor import Media, iter_tweets
+from twitter_client import TwitterClient
 
-
-@click.group()
-def cli():
-    pass
-
-
-cookie_path = ''
-
-
-def get_proxies():
-    proxies = {}
-    https_proxy = os.environ.get("HTTPS_PROXY")
-    if https_proxy:
-        proxies["https"] = https_proxy
-    return proxies
+# Anonymized Likes and UserMedia responses, checked and timed by benchmark_tweet_extractor.
+BENCHMARK_PAGE_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', name)
+    for name in ('likes_page.json', 'user_media_page.json')
+]
 
 
-def get_headers(headers, cookies) -> dict:
-    authed_headers = headers | {
-        'cookie': '; '.join(f'{k}={v}' for k, v in cookies.items()),
-        'referer': 'https://twitter.com/',
-        'x-csrf-token': cookies.get('ct0', ''),
-        'x-guest-token': cookies.get('guest_token', ''),
-        'x-twitter-auth-type': 'OAuth2Session' if cookies.get('auth_token') else '',
-        'x-twitter-active-user': 'yes',
-        'x-twitter-client-language': 'en',
-    }
-    return dict(sorted({k.lower(): v for k, v in authed_headers.items()}.items()))
-
-
-def build_params(params: dict) -> dict:
-    return {k: json.dumps(v) for k, v in params.items()}
+@click.group()
+@click.option('--offline',
+              is_flag=True,
+              help="Only use the cached or bundled Graphql API data, never fetch it from GitHub.")
+def cli(offline):
+    if offline:
+        GraphqlAPI.configure(offline=True)
 
 
 def find_all(obj: any, key: str) -> list:
@@ -88,97 +74,79 @@ def get_cursor(obj: any) -> str:
             return entry.get('content', {}).get('value', '')
 
 
-def send_get_request(api_name: str, params: dict = {}):
-    with open(cookie_path, 'r') as f:
-        cookies = json.load(f)
-    url, _, headers, features = GraphqlAPI.get_api_data(api_name)
-    headers = get_headers(headers, cookies)
-    params = build_params({"variables": params, "features": features})
-    response = requests.request("GET", url, params=params, headers=headers, proxies=get_proxies())
-    while response.status_code != 200:
-        logging.error("Request returned an error: {} {}".format(response.status_code,
-                                                                response.text))
-        time.sleep(5)
-        response = requests.request("GET",
-                                    url,
-                                    params=params,
-                                    headers=headers,
-                                    proxies=get_proxies())
-    return response.json()
-
-
-def get_id_by_username(username: str):
-    api_name = 'UserByScreenName'
-    params = {'screen_name': username}
-    json_response = send_get_request(api_name, params)
-    while json_response is None:
-        time.sleep(10)
-        json_response = send_get_request(api_name, params)
-    return find_one(json_response, 'rest_id')
-
-
-def get_favorite_tweets(username: str):
-    result = []
-    user_id = get_id_by_username(username)
+def get_favorite_tweets(client: TwitterClient, username: str, is_processed=None, full=False):
+    # Without full, stops at 500 tweets or after the first page whose tweets were all processed
+    # by earlier runs, which in steady state is the first page.
+    count = 0
+    seen = set()
+    user_id = client.get_id_by_username(username)
     api_name = 'Likes'
     params = {'userId': user_id, 'includePromotedContent': True, 'count': 1000}
-    json_response = send_get_request(api_name, params)
-    favorite_tweets = find_all(json_response, 'tweet_results')
-    result.extend(favorite_tweets)
-    while len(result) < 500:
+    json_response = client.send_get_request(api_name, params)
+    while True:
+        favorite_tweets = list(iter_tweets(json_response, seen))
+        all_processed = bool(is_processed) and all(
+            is_processed(favorite_tweet) for favorite_tweet in favorite_tweets)
+        count += len(favorite_tweets)
+        yield from favorite_tweets
+        if not full and (all_processed or count >= 500):
+            break
         cursor = get_cursor(json_response)
         if not cursor or cursor.startswith('-1|') or cursor.startswith('0|'):
             break
         params['cursor'] = cursor
-        json_response = send_get_request(api_name, params)
-        favorite_tweets = find_all(json_response, 'tweet_results')
-        result.extend(favorite_tweets)
-    return result
+        json_response = client.send_get_request(api_name, params)
 
 
-def read_prossesed_ids(username: str):
-    processed_ids = set()
-    filename = '{}.processed_ids'.format(username)
-    if not os.path.exists(filename):
-        logging.error('{} not exists, will download all images.'.format(filename))
-        return processed_ids
-    with open(filename, 'r') as f:
-        for processed_id in f:
-            processed_ids.add(processed_id.rstrip('\r\n'))
-    return processed_ids
+def download_image(engine: DownloadEngine,
+                   output_dir: str,
+                   image_url: str,
+                   job: DownloadJob = None):
+    filename = image_url.split('/')[-1]
+    output_path = os.path.join(output_dir, filename)
+    orig_image_url = '{}?name=orig'.format(image_url)
+    engine.submit(orig_image_url, output_path, job=job)
+
+
+def get_video_url(media: Media) -> str:
+    variants = [
+        variant for variant in (media.video_info or {}).get('variants', [])
+        if variant.get('content_type') == 'video/mp4'
+    ]
+    if not variants:
+        return None
+    return max(variants, key=lambda variant: variant.get('bitrate', 0))['url']
+
+
+def download_media(engine: DownloadEngine,
+                   output_dir: str,
+                   media: Media,
+                   existed_images: set = (),
+                   job: DownloadJob = None):
+    if media.type == 'photo':
+        if media.media_url_https.split('/')[-1] in existed_images:
+            return
+        download_image(engine, output_dir, media.media_url_https, job)
+        return
+    video_url = get_video_url(media) if media.type in ['video', 'animated_gif'] else None
+    if not video_url:
+        logging.error('Unsupport media type: {}, tweet url: {}'.format(media.type, media.url))
+        return
+    filename = urlparse(video_url).path.split('/')[-1]
+    if filename in existed_images:
+        return
+    engine.submit(video_url, os.path.join(output_dir, filename), job=job)
 
 
-def write_processed_id(username: str, processed_id: int):
-    filename = '{}.processed_ids'.format(username)
-    with open(filename, 'a') as f:
-        f.write('{}\n'.format(str(processed_id)))
+def is_existed_image(file_name: str) -> bool:
+    splits = file_name.split('.')
+    if len(splits) == 2 and splits[1] == 'mp4':
+        return True
+    return len(splits) == 2 and splits[1] in ['jpg', 'png'] and len(splits[0]) == 15
 
 
-def download_image(output_dir: str, image_url: str):
-    filename = image_url.split('/')[-1]
-    output_path = os.path.join(output_dir, filename)
-    if os.path.exists(output_path):
-        logging.warning('{} already exists, skip.'.format(output_path))
-        return
-    orig_image_url = '{}?name=orig'.format(image_url)
-    print('Downloading image {} to {}'.format(orig_image_url, output_path))
-    logging.info('Downloading image {} to {}'.format(orig_image_url, output_path))
-    r = requests.get(orig_image_url, proxies=get_proxies())
-    with open(output_path, "wb") as f:
-        f.write(r.content)
-
-
-def get_existed_images(scan_dir: str):
-    existed_images = set()
-    for file_name in os.listdir(scan_dir):
-        file_path = os.path.join(scan_dir, file_name)
-        if os.path.isdir(file_path):
-            existed_images = existed_images | get_existed_images(file_path)
-        else:
-            splits = file_name.split('.')
-            if len(splits) == 2 and splits[1] in ['jpg', 'png'] and len(splits[0]) == 15:
-                existed_images.add(file_name)
-    return existed_images
+def get_existed_images(scan_dirs: str, index_dir: str, root_cache: dict = None):
+    return get_file_names(scan_dirs.split(','), is_existed_image, index_dir, root_cache)
 
 
 @cli.command()
@@ -186,109 +154,142 @@ def get_existed_images(scan_dir: str):
 @click.option('--auth_cookie_path', required=True)
 @click.option('--output_dir', default='./output/', help="")
 @click.option('--scan_dirs', default='./', help="")
+@click.option('--index_dir',
+              default=DEFAULT_INDEX_DIR,
+              help="Directory of the persistent file name index of scan_dirs.")
 @click.option('--exclude_users', default='', help="")
+@click.option('--concurrency',
+              default=DEFAULT_CONCURRENCY,
+              help="Max number of images downloaded at the same time.")
+@click.option('--processed_store_path',
+              default=DEFAULT_STORE_PATH,
+              help="Path to the sqlite store of processed tweet ids.")
+@click.option('--full',
+              is_flag=True,
+              help="Walk all likes instead of stopping at already processed tweets.")
 @click.option('--log_path',
               default='./download_user_like_images.log',
               help="Path to output logging's log.")
-def download_user_like_images(username, auth_cookie_path, output_dir, scan_dirs, exclude_users,
-                              log_path):
+def download_user_like_images(username, auth_cookie_path, output_dir, scan_dirs, index_dir,
+                              exclude_users, concurrency, processed_store_path, full, log_path):
     logging.basicConfig(filename=log_path, format='%(asctime)s - %(message)s', level=logging.INFO)
     os.makedirs(output_dir, exist_ok=True)
 
-    global cookie_path
-    cookie_path = auth_cookie_path
+    processed_store = ProcessedStore(processed_store_path)
+    processed_store.import_text_file(username, '{}.processed_ids'.format(username))
+    logging.info('Processed ids num: {}'.format(processed_store.count(username)))
 
-    processed_ids = read_prossesed_ids(username)
-    logging.info('Processed ids num: {}'.format(len(processed_ids)))
-
-    existed_images = set()
-    for scan_dir in scan_dirs.split(','):
-        existed_images = existed_images | get_existed_images(scan_dir)
+    existed_images = get_existed_images(scan_dirs, index_dir)
     logging.info('existed images num: {}'.format(len(existed_images)))
 
     exclude_users = exclude_users.split(',') if exclude_users else []
 
-    image_urls = []
+    with processed_store, TwitterClient(auth_cookie_path) as client, \
+            DownloadEngine(concurrency) as engine:
+        download_like_images(client, engine, processed_store, username, output_dir, existed_images,
+                             exclude_users, full)
 
-    favorite_tweets = get_favorite_tweets(username)
-    for favorite_tweet in favorite_tweets:
-        user = find_one(favorite_tweet, 'user_results')
-        like_username = find_one(user, 'screen_name')
-        if like_username in exclude_users:
-            continue
-        if find_one(favorite_tweet, 'rest_id') in processed_ids:
+
+def download_like_images(client: TwitterClient,
+                         engine: DownloadEngine,
+                         processed_store: ProcessedStore,
+                         username: str,
+                         output_dir: str,
+                         existed_images: set,
+                         exclude_users: list,
+                         full: bool = False,
+                         job: DownloadJob = None):
+
+    def is_processed(favorite_tweet):
+        return favorite_tweet.screen_name in exclude_users or processed_store.contains(
+            username, favorite_tweet.rest_id)
+
+    for favorite_tweet in get_favorite_tweets(client, username, is_processed, full):
+        if favorite_tweet.screen_name in exclude_users:
             continue
-        write_processed_id(username, find_one(favorite_tweet, 'rest_id'))
-        extended_entities = find_one(favorite_tweet, 'extended_entities')
-        if not extended_entities:
+        if processed_store.contains(username, favorite_tweet.rest_id):
             continue
-        medias = extended_entities.get('media', [])
-        for media in medias:
-            media_name = media['media_url_https'].split('/')[-1]
-            if media_name in existed_images:
-                continue
-            media_type = media.get('type', '')
-            if media_type != 'photo':
-                logging.error('Unsupport media type: {}, tweet url: {}'.format(
-                    media_type, media['url']))
-                continue
-            image_urls.append(media['media_url_https'])
-
-    for image_url in image_urls:
-        download_image(output_dir, image_url)
-
-
-def get_tweets(username: str):
-    result = []
-    user_id = get_id_by_username(username)
+        processed_store.add(username, favorite_tweet.rest_id)
+        for media in favorite_tweet.medias:
+            download_media(engine, output_dir, media, existed_images, job)
+
+
+def get_tweets(client: TwitterClient, username: str, since_id: int = None):
+    # Tweet ids grow with time, so the walk can stop after the first page reaching since_id.
+    count = 0
+    seen = set()
+    user_id = client.get_id_by_username(username)
     api_name = 'UserMedia'
     params = {'userId': user_id, 'includePromotedContent': True, 'withVoice': True, 'count': 1000}
-    json_response = send_get_request(api_name, params)
-    tweets = find_all(json_response, 'tweet_results')
-    result.extend(tweets)
+    json_response = client.send_get_request(api_name, params)
+    tweets = list(iter_tweets(json_response, seen))
+    count += len(tweets)
+    yield from tweets
     while tweets:
+        # Only the timeline entries are ordered, a retweeted or quoted tweet may be much older.
+        if since_id is not None and any(int(tweet.timeline_id) <= since_id for tweet in tweets):
+            break
         cursor = get_cursor(json_response)
         if not cursor or cursor.startswith('-1|') or cursor.startswith('0|'):
             break
         params['cursor'] = cursor
-        json_response = send_get_request(api_name, params)
-        tweets = find_all(json_response, 'tweet_results')
-        result.extend(tweets)
-        print(len(result))
-    return result
+        json_response = client.send_get_request(api_name, params)
+        tweets = list(iter_tweets(json_response, seen))
+        count += len(tweets)
+        print(count)
+        yield from tweets
 
 
 @cli.command()
 @click.option('--username', required=True, help="")
 @click.option('--auth_cookie_path', required=True)
 @click.option('--output_dir', default='./output/', help="")
+@click.option('--concurrency',
+              default=DEFAULT_CONCURRENCY,
+              help="Max number of images downloaded at the same time.")
+@click.option('--processed_store_path',
+              default=DEFAULT_STORE_PATH,
+              help="Path to the sqlite store keeping the newest downloaded tweet id.")
+@click.option(
+    '--full',
+    is_flag=True,
+    help="Walk the whole media timeline instead of stopping at the newest downloaded tweet.")
 @click.option('--log_path',
               default='./download_user_tweet_images.log',
               help="Path to output logging's log.")
-def download_user_tweet_images(username, auth_cookie_path, output_dir, log_path):
+def download_user_tweet_images(username, auth_cookie_path, output_dir, concurrency,
+                               processed_store_path, full, log_path):
     logging.basicConfig(filename=log_path, format='%(asctime)s - %(message)s', level=logging.INFO)
     os.makedirs(output_dir, exist_ok=True)
 
-    global cookie_path
-    cookie_path = auth_cookie_path
-
-    image_urls = []
-
-    tweets = get_tweets(username)
-    for tweet in tweets:
-        extended_entities = find_one(tweet, 'extended_entities')
-        if not extended_entities:
+    with ProcessedStore(processed_store_path) as processed_store, \
+            TwitterClient(auth_cookie_path) as client, DownloadEngine(concurrency) as engine:
+        download_tweet_images(client, engine, processed_store, username, output_dir, full)
+
+
+def download_tweet_images(client: TwitterClient,
+                          engine: DownloadEngine,
+                          processed_store: ProcessedStore,
+                          username: str,
+                          output_dir: str,
+                          full: bool = False,
+                          job: DownloadJob = None):
+    since_id = processed_store.get_mark(username, 'UserMedia')
+    since_id = None if full or since_id is None else int(since_id)
+    logging.info('Newest downloaded tweet id: {}'.format(since_id))
+    newest_id = since_id or 0
+
+    job = job or DownloadJob(username)
+    for tweet in get_tweets(client, username, since_id):
+        if since_id is not None and int(tweet.timeline_id) <= since_id:
             continue
-        medias = extended_entities.get('media', [])
-        for media in medias:
-            media_type = media.get('type', '')
-            if media_type != 'photo':
-                print('Unsupport media type: {}, tweet url: {}'.format(media_type, media['url']))
-                continue
-            image_urls.append(media['media_url_https'])
-
-    for image_url in image_urls:
-        download_image(output_dir, image_url)
+        newest_id = max(newest_id, int(tweet.timeline_id))
+        for media in tweet.medias:
+            download_media(engine, output_dir, media, job=job)
+    # Only moved forward once the whole walk and every download went through.
+    job.join()
+    if newest_id and not job.failed_files:
+        processed_store.set_mark(username, 'UserMedia', newest_id)
 
 
 @cli.command()
@@ -303,5 +304,68 @@ def generate_auth_cookie(username, password):
     print('Saved to {}'.format(dump_path))
 
 
+def extract_tweets_by_find(page: dict) -> list:
+    # The traversal download_user_like_images used before iter_tweets, kept as the baseline of
+    # benchmark_tweet_extractor.
+    result = []
+    for tweet in find_all(page, 'tweet_results'):
+        user = find_one(tweet, 'user_results')
+        screen_name = find_one(user, 'screen_name')
+        rest_id = find_one(tweet, 'rest_id')
+        extended_entities = find_one(tweet, 'extended_entities')
+        result.append((rest_id, screen_name, extended_entities))
+    return result
+
+
+def summarize_found_tweets(records: list) -> set:
+    return {(rest_id, screen_name,
+             tuple(media['media_url_https']
+                   for media in (extended_entities or {}).get('media', [])))
+            for rest_id, screen_name, extended_entities in records}
+
+
+def summarize_tweets(tweets: list) -> set:
+    # The media of a retweeted or quoted tweet count as the media of its timeline entry, as the
+    # breadth-first search found them there.
+    medias = {}
+    for tweet in tweets:
+        medias.setdefault((tweet.timeline_id, tweet.screen_name),
+                          []).extend(media.media_url_https for media in tweet.medias)
+    return {(rest_id, screen_name, tuple(urls)) for (rest_id, screen_name), urls in medias.items()}
+
+
+@cli.command()
+@click.option('--page_paths',
+              default=','.join(BENCHMARK_PAGE_PATHS),
+              help="Comma separated paths of recorded Likes/UserMedia json responses.")
+@click.option('--repeat', default=20, help="")
+def benchmark_tweet_extractor(page_paths, repeat):
+    pages = []
+    for page_path in page_paths.split(','):
+        with open(page_path, 'r') as f:
+            pages.append(json.load(f))
+    repeat = max(1, repeat)
+
+    # Timing is only meaningful if both extractors find the same tweets and media.
+    for page_path, page in zip(page_paths.split(','), pages):
+        found = summarize_found_tweets(extract_tweets_by_find(page))
+        extracted = summarize_tweets(list(iter_tweets(page)))
+        if found != extracted:
+            raise click.ClickException(
+                'Extractors disagree on {}: only found by find_all/find_one {}, only by '
+                'iter_tweets {}'.format(page_path, sorted(found - extracted),
+                                        sorted(extracted - found)))
+        print('{}: {} tweets, same records from both extractors'.format(page_path, len(found)))
+
+    for name, extract in [('find_all/find_one', extract_tweets_by_find),
+                          ('iter_tweets', lambda page: list(iter_tweets(page)))]:
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            for page in pages:
+                extract(page)
+        elapsed = (time.perf_counter() - start_time) / repeat / len(pages)
+        print('{}: {:.3f} ms per page'.format(name, elapsed * 1000))
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from fs_walker import DEFAULT_WALK_WORKERS, iter_tree
+
+DEFAULT_INDEX_DIR = './fs_index'
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4')
+# A directory modified this close to the scan may still change within the same mtime tick, so
+# it is not trusted and gets re-listed next time.
+MTIME_GRACE_SECONDS = 2
+
+
+class FsIndex():
+
+    def __init__(self, root: str, index_dir: str = DEFAULT_INDEX_DIR):
+        self.root = os.path.abspath(root)
+        digest = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+        self.index_path = os.path.join(index_dir, '{}.json'.format(digest))
+        # Directory path relative to root -> {'mtime': ns, 'files': [...], 'dirs': [...]}
+        self.dirs = {}
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            logging.error('Broken index {} of {}, rebuild it.'.format(self.index_path, self.root))
+            return
+        if data.get('root') == self.root:
+            self.dirs = data.get('dirs', {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = '{}.tmp'.format(self.index_path)
+        with open(temp_path, 'w') as f:
+            json.dump({'root': self.root, 'dirs': self.dirs}, f)
+        os.replace(temp_path, self.index_path)
+
+    def list_dir(self, dir_path: str, mtime: int) -> dict:
+        files = []
+        dirs = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.name.lower().endswith(MEDIA_EXTENSIONS):
+                    files.append(entry.name)
+        if time.time() - mtime / 1e9 < MTIME_GRACE_SECONDS:
+            mtime = None
+        return {'mtime': mtime, 'files': files, 'dirs': dirs}
+
+    def refresh(self, workers: int = DEFAULT_WALK_WORKERS):
+        # Directories are stat'ed, and re-listed when changed, by several threads at a time.
+        old_dirs = self.dirs
+
+        def visit(rel_path):
+            dir_path = os.path.join(self.root, rel_path)
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError as e:
+                logging.error('Can not stat {}: {}'.format(dir_path, e))
+                return None, []
+            entry = old_dirs.get(rel_path)
+            listed = not entry or entry['mtime'] != mtime
+            if listed:
+                entry = self.list_dir(dir_path, mtime)
+            return (entry, listed), [os.path.join(rel_path, name) for name in entry['dirs']]
+
+        self.dirs = {}
+        listed_count = 0
+        for rel_path, result in iter_tree([''], visit, workers):
+            if result is None:
+                continue
+            self.dirs[rel_path], listed = result
+            listed_count += listed
+        logging.info('Indexed {}: {} directories, {} re-listed'.format(
+            self.root, len(self.dirs), listed_count))
+
+    def file_names(self):
+        for entry in self.dirs.values():
+            yield from entry['files']
+
+
+def get_root_file_names(scan_dir: str, index_dir: str = DEFAULT_INDEX_DIR) -> list:
+    index = FsIndex(scan_dir, index_dir)
+    index.load()
+    index.refresh()
+    index.save()
+    return list(index.file_names())
+
+
+def get_file_names(scan_dirs: list,
+                   name_filter,
+                   index_dir: str = DEFAULT_INDEX_DIR,
+                   root_cache: dict = None) -> set:
+    # root_cache (scan dir -> names) lets several jobs of one process share a single refresh.
+    file_names = set()
+    for scan_dir in scan_dirs:
+        if root_cache is None:
+            names = get_root_file_names(scan_dir, index_dir)
+        else:
+            key = os.path.abspath(scan_dir)
+            if key not in root_cache:
+                root_cache[key] = get_root_file_names(scan_dir, index_dir)
+            names = root_cache[key]
+        file_names.update(name for name in names if name_filter(name))
+    return file_names
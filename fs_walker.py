@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import functools
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+import click
+
+# Directories listed at the same time. Listing is latency bound on network drives, not CPU bound.
+DEFAULT_WALK_WORKERS = 16
+PIXIV_PATTERN = re.compile(r'\d+_p\d+')
+
+
+@click.group()
+def cli():
+    pass
+
+
+def is_image(file_name: str) -> bool:
+    f = file_name.lower()
+    return f.endswith(".png") or f.endswith(".jpg") or \
+        f.endswith(".jpeg") or f.endswith(".bmp") or \
+        f.endswith(".gif") or '.jpg' in f or f.endswith(".svg")
+
+
+def is_twitter_image(file_name: str) -> bool:
+    splits = file_name.split('.')
+    return len(splits) == 2 and splits[1] in ['jpg', 'png'] and len(splits[0]) == 15
+
+
+def is_pixiv_image(file_name: str) -> bool:
+    return bool(PIXIV_PATTERN.match(file_name.split('.')[0]))
+
+
+def iter_tree(roots: list, visit, workers: int = DEFAULT_WALK_WORKERS):
+    # Calls visit(node) -> (result, child nodes) on roots and all their descendants in a thread
+    # pool, and yields (node, result) breadth first in the order visit returned the children, so
+    # that the output does not depend on the number of workers.
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='walk') as executor:
+        pending = deque((root, executor.submit(visit, root)) for root in roots)
+        try:
+            while pending:
+                node, future = pending.popleft()
+                result, children = future.result()
+                pending.extend((child, executor.submit(visit, child)) for child in children)
+                yield node, result
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def matches(entry: os.DirEntry, patterns) -> bool:
+    path = entry.path.replace('\\', '/')
+    return any(fnmatch(entry.name, pattern) or fnmatch(path, pattern) for pattern in patterns)
+
+
+def walk(roots: list,
+         name_filter=None,
+         include=(),
+         exclude=(),
+         workers: int = DEFAULT_WALK_WORKERS):
+    # Yields the os.DirEntry of every file under roots whose name passes name_filter, matches
+    # one of the include patterns if any, and none of the exclude patterns. Excluded directories
+    # are not entered. The patterns are matched against the name and the path. The stat of the
+    # yielded entries is already cached, it was done by the worker that listed the directory.
+
+    def visit(dir_path):
+        files = []
+        dirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                if exclude and matches(entry, exclude):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif (name_filter is None or name_filter(entry.name)) and \
+                        (not include or matches(entry, include)):
+                    entry.stat()
+                    files.append(entry)
+        except OSError as e:
+            logging.error('Can not list {}: {}'.format(dir_path, e))
+        return files, dirs
+
+    for _, files in iter_tree(roots, visit, workers):
+        yield from files
+
+
+def make_tree(root: str, depth: int, fanout: int, files_per_dir: int) -> int:
+    # Creates a synthetic tree of empty images, returns the number of files.
+    count = 0
+    stack = [(root, 0)]
+    while stack:
+        dir_path, level = stack.pop()
+        os.makedirs(dir_path, exist_ok=True)
+        for i in range(files_per_dir):
+            name = '{:015d}.jpg'.format(count) if i % 2 else '{}_p{}.png'.format(count, i)
+            open(os.path.join(dir_path, name), 'wb').close()
+            count += 1
+        if level < depth:
+            stack.extend(
+                (os.path.join(dir_path, 'd{}'.format(i)), level + 1) for i in range(fanout))
+    return count
+
+
+def walk_with_os_walk(root: str) -> int:
+    # As remove_same did: os.walk, then a stat per file.
+    count = 0
+    for dir_path, dirs, files in os.walk(root):
+        for file in files:
+            if is_image(file):
+                os.stat(os.path.join(dir_path, file))
+                count += 1
+    return count
+
+
+def walk_with_serial_scandir(root: str) -> int:
+    # As deduplication and update_twitter_image_to_original_size did: one scandir at a time.
+    count = 0
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif is_image(entry.name):
+                    entry.stat()
+                    count += 1
+    return count
+
+
+def count_walked(root: str, workers: int) -> int:
+    return sum(1 for _ in walk([root], is_image, workers=workers))
+
+
+@cli.command()
+@click.option('--depth', default=4, help="Depth of the generated tree.")
+@click.option('--fanout', default=5, help="Sub directories per directory.")
+@click.option('--files_per_dir', default=20, help="Files per directory.")
+@click.option('--workers', default='1,4,16', help="Comma separated worker counts to compare.")
+@click.option('--latency',
+              default=0.0,
+              help="Seconds added to every directory listing, to emulate a network drive.")
+def benchmark(depth, fanout, files_per_dir, workers, latency):
+    """Compare the parallel walker with the serial walkers on a generated tree."""
+    root = tempfile.mkdtemp(prefix='walker_benchmark_')
+    scandir = os.scandir
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(latency)
+        return scandir(*args, **kwargs)
+
+    try:
+        count = make_tree(root, depth, fanout, files_per_dir)
+        cases = [('os.walk + stat', lambda: walk_with_os_walk(root)),
+                 ('serial scandir', lambda: walk_with_serial_scandir(root))]
+        for worker_count in [int(w) for w in workers.split(',')]:
+            cases.append(('walk, {} workers'.format(worker_count),
+                          functools.partial(count_walked, root, worker_count)))
+        os.scandir = slow_scandir
+        baseline = None
+        for name, function in cases:
+            start_time = time.perf_counter()
+            found = function()
+            elapsed = time.perf_counter() - start_time
+            baseline = baseline or elapsed
+            print('{:<20} {:.3f}s, speedup {:.2f}x, {} of {} files'.format(
+                name, elapsed, baseline / elapsed, found, count))
+    finally:
+        os.scandir = scandir
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,50 +1,149 @@
+import json
+import logging
+import os
+import threading
 import time
 
 import requests
 
+API_URL = os.environ.get(
+    'GRAPHQL_API_URL',
+    'https://github.com/fa0311/TwitterInternalAPIDocument/raw/master/docs/json/API.json')
+CACHE_PATH = os.environ.get(
+    'GRAPHQL_API_CACHE_PATH',
+    os.path.join(os.path.expanduser('~'), '.cache', 'image-scripts', 'API.json'))
+# Shipped next to this file as the last resort when there is no cache yet.
+BUNDLED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'API.json')
+CACHE_TTL = 24 * 60 * 60
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 3
+
 
 class GraphqlAPI():
     initialized = False
+    offline = os.environ.get('GRAPHQL_API_OFFLINE', '') not in ('', '0')
+    url = API_URL
+    cache_path = CACHE_PATH
+    cache_ttl = CACHE_TTL
+    lock = threading.Lock()
+    refresh_thread = None
 
     def __new__(cls):
         raise Exception('Do not instantiate this class!')
 
+    @classmethod
+    def configure(cls, url: str = None, cache_path: str = None, offline: bool = None) -> None:
+        if url is not None:
+            cls.url = url
+        if cache_path is not None:
+            cls.cache_path = cache_path
+        if offline is not None:
+            cls.offline = offline
+
     @classmethod
     def init(cls) -> None:
-        while not cls.update_api_data():
-            time.sleep(10)
-        cls.initialized = True
+        with cls.lock:
+            if cls.initialized:
+                return
+            if cls.load_file(cls.cache_path):
+                cls.initialized = True
+                age = time.time() - os.path.getmtime(cls.cache_path)
+                if age > cls.cache_ttl and not cls.offline:
+                    cls.refresh_in_background()
+                return
+            if cls.load_file(BUNDLED_PATH):
+                cls.initialized = True
+                if not cls.offline:
+                    cls.refresh_in_background()
+                return
+            if cls.offline:
+                raise RuntimeError('No cached Graphql API data in {} or {} in offline mode'.format(
+                    cls.cache_path, BUNDLED_PATH))
+            for _ in range(FETCH_RETRIES):
+                if cls.update_api_data():
+                    cls.initialized = True
+                    return
+                time.sleep(10)
+            raise RuntimeError('Can not get Graphql API data from {}'.format(cls.url))
 
     @classmethod
-    def update_api_data(cls):
-        response = requests.get(
-            'https://github.com/fa0311/TwitterInternalAPIDocument/raw/master/docs/json/API.json',
-            timeout=300)
-        if response.status_code != 200:
-            print('Request returned an error: {} {}.'.format(response.status_code, response.text))
+    def validate(cls, json_data) -> bool:
+        if not isinstance(json_data, dict):
+            print('Graphql API data is not a json object')
             return False
-        json_data = response.json()
-
         if not json_data.get('graphql', {}):
             print('Can not get Graphql API data from json')
             return False
         if not json_data.get('header', {}):
             print('Can not get header data from json')
             return False
+        return True
 
+    @classmethod
+    def load(cls, json_data) -> None:
         cls.graphql_api_data = json_data['graphql']
         cls.headers = json_data['header']
+
+    @classmethod
+    def load_file(cls, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                json_data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error('Can not read Graphql API data from {}: {}'.format(path, e))
+            return False
+        if not cls.validate(json_data):
+            return False
+        cls.load(json_data)
         return True
 
+    @classmethod
+    def update_api_data(cls) -> bool:
+        try:
+            response = requests.get(cls.url, timeout=FETCH_TIMEOUT)
+        except requests.RequestException as e:
+            print('Request failed: {}.'.format(e))
+            return False
+        if response.status_code != 200:
+            print('Request returned an error: {} {}.'.format(response.status_code, response.text))
+            return False
+        try:
+            json_data = response.json()
+        except ValueError:
+            print('Graphql API data is not valid json')
+            return False
+        if not cls.validate(json_data):
+            return False
+
+        cls.load(json_data)
+        os.makedirs(os.path.dirname(cls.cache_path) or '.', exist_ok=True)
+        temp_path = '{}.tmp'.format(cls.cache_path)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(json_data, f)
+        os.replace(temp_path, cls.cache_path)
+        return True
+
+    @classmethod
+    def refresh_in_background(cls) -> None:
+        if cls.refresh_thread and cls.refresh_thread.is_alive():
+            return
+        cls.refresh_thread = threading.Thread(target=cls.update_api_data,
+                                              name='graphql-api-refresh',
+                                              daemon=True)
+        cls.refresh_thread.start()
+
+    @classmethod
+    def get_headers(cls) -> dict:
+        cls.init()
+        return cls.headers
+
     @classmethod
     def get_api_data(cls, api_name):
-        if not cls.initialized:
-            raise RuntimeError('Class has not initialized!')
+        cls.init()
         if api_name not in cls.graphql_api_data:
             raise ValueError('Unkonw API name: {}'.format(api_name))
 
         api_data = cls.graphql_api_data[api_name]
         return api_data['url'], api_data['method'], cls.headers, api_data['features']
-
-
-GraphqlAPI.init()
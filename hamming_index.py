@@ -0,0 +1,59 @@
+import numpy
+
+HASH_BITS = 64
+# Number of set bits of every byte value.
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+def popcount(values: numpy.ndarray) -> numpy.ndarray:
+    values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+    return POPCOUNT[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1, dtype=numpy.int64)
+
+
+def split_blocks(block_count: int, bits: int = HASH_BITS) -> list:
+    # Returns (shift, mask) of block_count blocks of bits as even as possible.
+    blocks = []
+    shift = 0
+    for i in range(block_count):
+        width = bits // block_count + (1 if i < bits % block_count else 0)
+        blocks.append((shift, (1 << width) - 1))
+        shift += width
+    return blocks
+
+
+class HammingIndex():
+    # Multi-index hash of packed 64 bits hashes. The hashes are cut into threshold + 1 blocks, and
+    # by the pigeonhole principle two hashes at most threshold bits apart have at least one block
+    # in common. Every block is a sorted array, so a query is a binary search per block followed
+    # by an exact distance check of the few candidates.
+
+    def __init__(self, values, threshold: int = 0):
+        self.values = numpy.ascontiguousarray(values, dtype=numpy.uint64)
+        self.threshold = threshold
+        self.blocks = []
+        for shift, mask in split_blocks(min(threshold + 1, HASH_BITS)):
+            keys = (self.values >> numpy.uint64(shift)) & numpy.uint64(mask)
+            order = numpy.argsort(keys, kind='stable')
+            self.blocks.append((shift, mask, keys[order], order))
+
+    def __len__(self):
+        return len(self.values)
+
+    def candidates(self, value: int) -> numpy.ndarray:
+        found = []
+        for shift, mask, keys, order in self.blocks:
+            key = numpy.uint64((value >> shift) & mask)
+            start = numpy.searchsorted(keys, key, side='left')
+            end = numpy.searchsorted(keys, key, side='right')
+            if start != end:
+                found.append(order[start:end])
+        if not found:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(found))
+
+    def query(self, value: int) -> list:
+        # Returns the sorted (position, distance) of the hashes at most threshold bits from value.
+        positions = self.candidates(value)
+        distances = popcount(self.values[positions] ^ numpy.uint64(value))
+        matched = distances <= self.threshold
+        return list(zip(positions[matched].tolist(), distances[matched].tolist()))
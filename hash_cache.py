@@ -0,0 +1,80 @@
+import os
+
+from perceptual_hash import HASH_KINDS
+from sqlite_store import SqliteStore
+
+DEFAULT_HASH_CACHE_PATH = './image_hashes.sqlite'
+BATCH_SIZE = 500
+# PRAGMA user_version of the current schema, older caches are migrated once when opened.
+SCHEMA_VERSION = 1
+SIGN_BIT = 1 << 63
+
+
+def to_signed(value: int) -> int:
+    # SQLite integers are signed 64 bits.
+    return value - (SIGN_BIT << 1) if value >= SIGN_BIT else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (SIGN_BIT << 1) if value < 0 else value
+
+
+class HashCache(SqliteStore):
+    # Perceptual hashes of image files, one column per kind of HASH_KINDS, keyed by path and valid
+    # as long as the size and mtime of the file are unchanged.
+
+    INSERT_SQL = ('INSERT OR REPLACE INTO image_hashes (path, size, mtime, {}) '
+                  'VALUES (?, ?, ?, {})').format(', '.join(HASH_KINDS),
+                                                 ', '.join('?' * len(HASH_KINDS)))
+
+    def __init__(self, path: str = DEFAULT_HASH_CACHE_PATH, batch_size: int = BATCH_SIZE):
+        super().__init__(path, batch_size)
+
+    def create_tables(self):
+        columns = ', '.join('{} INTEGER NOT NULL'.format(kind) for kind in HASH_KINDS)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            # Hex average hashes of full decodes, from before the hashes were computed together.
+            self.conn.execute('DROP TABLE IF EXISTS hashes')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS image_hashes ('
+                          'path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                          'mtime INTEGER NOT NULL, {})'.format(columns))
+        if version < SCHEMA_VERSION:
+            self.conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def get(self, path: str, stat: os.stat_result) -> tuple:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, {} FROM image_hashes WHERE path = ?'.format(
+                    ', '.join(HASH_KINDS)), (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return tuple(to_unsigned(value) for value in row[2:])
+
+    def put(self, path: str, stat: os.stat_result, hashes):
+        # hashes holds one unsigned 64 bits value per kind of HASH_KINDS.
+        row = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        row += tuple(to_signed(int(value)) for value in hashes)
+        self.queue(row)
+
+    def iter_root(self, root: str):
+        # Yields (path, hashes) of every cached file under root, without touching the disk.
+        prefix = os.path.join(os.path.abspath(root), '')
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT path, {} FROM image_hashes WHERE substr(path, 1, ?) = ? '
+                'ORDER BY path'.format(', '.join(HASH_KINDS)), (len(prefix), prefix)).fetchall()
+        for row in rows:
+            yield row[0], tuple(to_unsigned(value) for value in row[1:])
+
+    def prune(self, root: str, seen_paths: set) -> int:
+        # Evicts the entries under root of files that are gone. Only the paths missing from the
+        # current scan are checked on disk.
+        seen_paths = {os.path.abspath(path) for path in seen_paths}
+        removed = [(path,)
+                   for path, _ in self.iter_root(root)
+                   if path not in seen_paths and not os.path.exists(path)]
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM image_hashes WHERE path = ?', removed)
+        return len(removed)
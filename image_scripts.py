@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import importlib
+import subprocess
+import sys
+import time
+
+import click
+
+# Subcommand name -> (module whose click group is loaded on use, short help).
+SUBCOMMANDS = {
+    'twitter': ('download_twitter_images', 'Download images of Twitter likes and timelines.'),
+    'pixiv': ('download_pixiv_images', 'Download images of Pixiv bookmarks and users.'),
+    'batch': ('batch_runner', 'Run Twitter and Pixiv jobs of a spec file concurrently.'),
+    'dedup': ('deduplication', 'Remove perceptually duplicated images.'),
+    'remove-same': ('remove_same', 'Remove images already present in a base directory.'),
+    'apply-plan': ('dedup_plan', 'Apply a plan written by dedup or remove-same.'),
+    'upgrade-originals':
+        ('update_twitter_image_to_original_size', 'Replace Twitter images with the originals.'),
+    'walker': ('fs_walker', 'Benchmark the parallel directory walker.'),
+}
+
+HELP_BUDGET = 0.3
+SUBCOMMAND_HELP_BUDGET = 1.0
+
+
+class LazyGroup(click.Group):
+
+    def list_commands(self, ctx):
+        return sorted(list(SUBCOMMANDS) + super().list_commands(ctx))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in SUBCOMMANDS:
+            module_name, help = SUBCOMMANDS[cmd_name]
+            command = importlib.import_module(module_name).cli
+            command.help = command.help or help
+            return command
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        # Listing the subcommands must not import them, so their help comes from SUBCOMMANDS.
+        rows = []
+        for cmd_name in self.list_commands(ctx):
+            if cmd_name in SUBCOMMANDS:
+                rows.append((cmd_name, SUBCOMMANDS[cmd_name][1]))
+                continue
+            command = super().get_command(ctx, cmd_name)
+            if command is not None and not command.hidden:
+                rows.append((cmd_name, command.get_short_help_str()))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
+def cli():
+    pass
+
+
+@cli.command(context_settings={
+    'ignore_unknown_options': True,
+    'allow_extra_args': True,
+    'help_option_names': []
+})
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+def pixiv_auth(args):
+    """Get or refresh a Pixiv OAuth token."""
+    import pixiv_auth
+    pixiv_auth.main(list(args))
+
+
+def measure(args: list, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, __file__] + args,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@cli.command()
+@click.option('--repeat', default=5, help="Runs per command, the fastest one is kept.")
+@click.option('--help_budget', default=HELP_BUDGET, help="Seconds allowed for --help.")
+@click.option('--subcommand_help_budget',
+              default=SUBCOMMAND_HELP_BUDGET,
+              help="Seconds allowed for '<subcommand> --help'.")
+def benchmark_startup(repeat, help_budget, subcommand_help_budget):
+    """Check that --help and subcommand --help start within budget."""
+    cases = [(['--help'], help_budget)]
+    cases += [([name, '--help'], subcommand_help_budget) for name in sorted(SUBCOMMANDS)]
+    cases += [(['pixiv-auth', '--help'], subcommand_help_budget)]
+    over_budget = False
+    for args, budget in cases:
+        elapsed = measure(args, repeat)
+        status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+        over_budget = over_budget or elapsed > budget
+        print('{:<32} {:.3f}s (budget {:.3f}s) {}'.format(' '.join(args), elapsed, budget, status))
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -200,7 +200,7 @@ def login(username: str, password: str, **kwargs) -> Client:
         "guest_token": None,
         "flow_token": None,
     },
-                    headers=GraphqlAPI.headers | {
+                    headers=GraphqlAPI.get_headers() | {
                         'content-type': 'application/json',
                         'x-twitter-active-user': 'yes',
                         'x-twitter-client-language': 'en',
@@ -0,0 +1,77 @@
+import numpy
+from PIL import Image
+
+HASH_KINDS = ('ahash', 'dhash', 'phash')
+# Images are decoded to no less than this size for hashing, 8 times the 8x8 hash grid.
+DECODE_SIZE = 64
+# Side of the grayscale sample every hash kind is computed from.
+SAMPLE_SIZE = 32
+HASH_SIZE = 8
+
+
+def open_for_hash(img):
+    # Image.open only parses the header, so files that are not images fail before any decoding.
+    # JPEGs are then decoded at up to 1/8 scale by the DCT, other formats are shrunk with a box
+    # reduce before the final resampling.
+    image = Image.open(img)
+    image.draft('L', (DECODE_SIZE, DECODE_SIZE))
+    image = image.convert('L')
+    image.thumbnail((DECODE_SIZE, DECODE_SIZE), reducing_gap=2.0)
+    return image
+
+
+def load_sample(img) -> numpy.ndarray:
+    image = open_for_hash(img).resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+    return numpy.asarray(image, dtype=numpy.float32)
+
+
+def box_matrix(size_in: int, size_out: int) -> numpy.ndarray:
+    # (size_out, size_in) weights averaging the input cells covered by every output cell.
+    edges = numpy.linspace(0, size_in, size_out + 1)
+    cells = numpy.arange(size_in)
+    overlap = numpy.clip(
+        numpy.minimum(edges[1:, None], cells[None, :] + 1) -
+        numpy.maximum(edges[:-1, None], cells[None, :]), 0, None)
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(numpy.float32)
+
+
+def dct_matrix(size: int) -> numpy.ndarray:
+    # Unnormalized DCT-II, as scipy.fftpack.dct used by imagehash.phash.
+    k = numpy.arange(size)[:, None]
+    n = numpy.arange(size)[None, :]
+    return (2 * numpy.cos(numpy.pi * k * (2 * n + 1) / (2 * size))).astype(numpy.float32)
+
+
+ROWS = box_matrix(SAMPLE_SIZE, HASH_SIZE)
+DIFF_COLUMNS = box_matrix(SAMPLE_SIZE, HASH_SIZE + 1)
+DCT = dct_matrix(SAMPLE_SIZE)
+
+
+def pack_bits(bits: numpy.ndarray) -> numpy.ndarray:
+    # (N, 8, 8) booleans to N uint64, first bit highest as the hex of imagehash.
+    packed = numpy.packbits(bits.reshape(len(bits), -1), axis=1)
+    return packed.view('>u8').reshape(-1).astype(numpy.uint64)
+
+
+def average_hashes(samples: numpy.ndarray) -> numpy.ndarray:
+    small = ROWS @ samples @ ROWS.T
+    return pack_bits(small > small.mean(axis=(1, 2), keepdims=True))
+
+
+def difference_hashes(samples: numpy.ndarray) -> numpy.ndarray:
+    small = ROWS @ samples @ DIFF_COLUMNS.T
+    return pack_bits(small[:, :, 1:] > small[:, :, :-1])
+
+
+def perception_hashes(samples: numpy.ndarray) -> numpy.ndarray:
+    low = (DCT @ samples @ DCT.T)[:, :HASH_SIZE, :HASH_SIZE]
+    return pack_bits(low > numpy.median(low, axis=(1, 2), keepdims=True))
+
+
+def compute_hashes(samples: numpy.ndarray) -> numpy.ndarray:
+    # (N, SAMPLE_SIZE, SAMPLE_SIZE) samples to (N, len(HASH_KINDS)) uint64 hashes.
+    samples = numpy.asarray(samples, dtype=numpy.float32).reshape(-1, SAMPLE_SIZE, SAMPLE_SIZE)
+    return numpy.stack(
+        [average_hashes(samples),
+         difference_hashes(samples),
+         perception_hashes(samples)], axis=1)
@@ -12,8 +12,8 @@ from pprint import pprint
 from secrets import token_urlsafe
 from sys import exit
 from urllib.parse import urlencode
-from selenium import webdriver
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+
+from pixiv_token import DEFAULT_TOKEN_CACHE_PATH, TokenCache
 
 # Latest app version can be found using GET /v1/application-info/android
 USER_AGENT = "PixivIOSApp/7.13.3 (iOS 14.6; iPhone13,2)"
@@ -57,6 +57,10 @@ def print_auth_token_response(response):
 
 
 def login():
+    # Selenium is only needed here and is slow to import, so the other commands skip it.
+    from selenium import webdriver
+    from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+
     caps = DesiredCapabilities.CHROME.copy()
     caps["goog:loggingPrefs"] = {"performance": "ALL"}  # enable performance logs
 
@@ -113,25 +117,32 @@ def login():
     print_auth_token_response(response)
 
 
-def refresh(refresh_token):
-    response = requests.post(AUTH_TOKEN_URL,
-                             data={
-                                 "client_id": CLIENT_ID,
-                                 "client_secret": CLIENT_SECRET,
-                                 "grant_type": "refresh_token",
-                                 "include_policy": "true",
-                                 "refresh_token": refresh_token,
-                             },
-                             headers={
-                                 "user-agent": USER_AGENT,
-                                 "app-os-version": "14.6",
-                                 "app-os": "ios",
-                             },
-                             **REQUESTS_KWARGS)
+def request_token(refresh_token, auth_token_url=AUTH_TOKEN_URL):
+    return requests.post(auth_token_url,
+                         data={
+                             "client_id": CLIENT_ID,
+                             "client_secret": CLIENT_SECRET,
+                             "grant_type": "refresh_token",
+                             "include_policy": "true",
+                             "refresh_token": refresh_token,
+                         },
+                         headers={
+                             "user-agent": USER_AGENT,
+                             "app-os-version": "14.6",
+                             "app-os": "ios",
+                         },
+                         **REQUESTS_KWARGS)
+
+
+def refresh(refresh_token, token_cache_path=DEFAULT_TOKEN_CACHE_PATH):
+    response = request_token(refresh_token)
     print_auth_token_response(response)
+    # The downloaders reuse the new access token instead of refreshing it again.
+    data = response.json()
+    TokenCache(token_cache_path).put(refresh_token, data["access_token"], data.get("expires_in", 0))
 
 
-def main():
+def main(argv=None):
     parser = ArgumentParser()
     subparsers = parser.add_subparsers()
     parser.set_defaults(func=lambda _: parser.print_usage())
@@ -139,8 +150,9 @@ def main():
     login_parser.set_defaults(func=lambda _: login())
     refresh_parser = subparsers.add_parser("refresh")
     refresh_parser.add_argument("refresh_token")
-    refresh_parser.set_defaults(func=lambda ns: refresh(ns.refresh_token))
-    args = parser.parse_args()
+    refresh_parser.add_argument("--token_cache_path", default=DEFAULT_TOKEN_CACHE_PATH)
+    refresh_parser.set_defaults(func=lambda ns: refresh(ns.refresh_token, ns.token_cache_path))
+    args = parser.parse_args(argv)
     args.func(args)
 
 
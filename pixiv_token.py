@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from uuid import uuid4
+
+DEFAULT_TOKEN_CACHE_PATH = './pixiv_token.json'
+# An access token is refreshed this long before it expires, so it does not expire mid-run.
+REFRESH_MARGIN_SECONDS = 300
+
+
+def get_token_key(refresh_token: str) -> str:
+    # The refresh token is not written to the cache, only a digest telling its entries apart.
+    return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()[:16]
+
+
+class TokenCache():
+    # Pixiv access tokens and their expiry, keyed by the refresh token they were issued for.
+
+    def __init__(self,
+                 path: str = DEFAULT_TOKEN_CACHE_PATH,
+                 refresh_margin: float = REFRESH_MARGIN_SECONDS):
+        self.path = path
+        self.refresh_margin = refresh_margin
+
+    def read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logging.error('Broken token cache {}, ignored.'.format(self.path))
+            return {}
+
+    def write(self, tokens: dict):
+        temp_path = '{}.{}.tmp'.format(self.path, uuid4().hex)
+        # Access tokens are credentials, only the owner may read them.
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            json.dump(tokens, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def get(self, refresh_token: str) -> str:
+        # Returns the cached access token, or None if missing or about to expire.
+        cached = self.read().get(get_token_key(refresh_token))
+        if not cached or time.time() >= cached['expires_at'] - self.refresh_margin:
+            return None
+        return cached['access_token']
+
+    def put(self, refresh_token: str, access_token: str, expires_in: float):
+        tokens = self.read()
+        tokens[get_token_key(refresh_token)] = {
+            'access_token': access_token,
+            'expires_at': time.time() + expires_in,
+        }
+        self.write(tokens)
+
+    def invalidate(self, refresh_token: str):
+        tokens = self.read()
+        if tokens.pop(get_token_key(refresh_token), None) is not None:
+            self.write(tokens)
@@ -0,0 +1,85 @@
+import logging
+import os
+import time
+
+from sqlite_store import SqliteStore
+
+DEFAULT_STORE_PATH = './processed_ids.sqlite'
+BATCH_SIZE = 500
+
+
+class ProcessedStore(SqliteStore):
+
+    INSERT_SQL = 'INSERT OR IGNORE INTO processed (account, id) VALUES (?, ?)'
+    PENDING_TYPE = set
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, batch_size: int = BATCH_SIZE):
+        super().__init__(path, batch_size)
+
+    def create_tables(self):
+        self.conn.execute('CREATE TABLE IF NOT EXISTS processed ('
+                          'account TEXT NOT NULL, id TEXT NOT NULL, '
+                          'PRIMARY KEY (account, id)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS marks ('
+                          'account TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, '
+                          'time REAL NOT NULL, PRIMARY KEY (account, name)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS imports ('
+                          'path TEXT PRIMARY KEY, account TEXT NOT NULL, '
+                          'count INTEGER NOT NULL, time REAL NOT NULL)')
+
+    def contains(self, account: str, processed_id) -> bool:
+        key = (account, str(processed_id))
+        with self.lock:
+            if key in self.pending:
+                return True
+            row = self.conn.execute('SELECT 1 FROM processed WHERE account = ? AND id = ?',
+                                    key).fetchone()
+        return row is not None
+
+    def add(self, account: str, processed_id):
+        self.queue((account, str(processed_id)))
+
+    def count(self, account: str) -> int:
+        self.flush()
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM processed WHERE account = ?',
+                                     (account,)).fetchone()[0]
+
+    def get_mark(self, account: str, name: str) -> str:
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM marks WHERE account = ? AND name = ?',
+                                    (account, name)).fetchone()
+        return row[0] if row else None
+
+    def set_mark(self, account: str, name: str, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO marks (account, name, value, time) VALUES (?, ?, ?, ?)',
+                (account, name, str(value), time.time()))
+
+    def import_text_file(self, account: str, path: str):
+        # One-time import of the legacy '<account>.processed_ids' files, one id per line.
+        if not os.path.exists(path):
+            return
+        path = os.path.abspath(path)
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM imports WHERE path = ?', (path,)).fetchone():
+                return
+        count = 0
+        with open(path, 'r') as f, self.lock, self.conn:
+            batch = []
+            for line in f:
+                processed_id = line.rstrip('\r\n')
+                if not processed_id:
+                    continue
+                batch.append((account, processed_id))
+                if len(batch) >= self.batch_size:
+                    self.conn.executemany(self.INSERT_SQL, batch)
+                    count += len(batch)
+                    batch = []
+            self.conn.executemany(self.INSERT_SQL, batch)
+            count += len(batch)
+            self.conn.execute(
+                'INSERT INTO imports (path, account, count, time) VALUES (?, ?, ?, ?)',
+                (path, account, count, time.time()))
+        logging.info('Imported {} processed ids of {} from {}'.format(count, account, path))
@@ -0,0 +1,155 @@
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+MAX_RETRIES = 8
+BASE_DELAY = 1
+MAX_DELAY = 300
+# Once fewer than this fraction of the window is left, requests are spread evenly until reset.
+PACING_FRACTION = 0.1
+
+
+class RequestError(Exception):
+    pass
+
+
+class EndpointState():
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.last_request = 0
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.retries = 0
+
+
+class RateLimitScheduler():
+
+    def __init__(self,
+                 max_retries: int = MAX_RETRIES,
+                 base_delay: float = BASE_DELAY,
+                 max_delay: float = MAX_DELAY,
+                 clock=time.time,
+                 sleep=time.sleep):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.endpoints = {}
+        # Several jobs of a batch share the scheduler of an account from their own threads. The
+        # state is only read and written under the lock, the sleeps happen outside of it.
+        self.lock = threading.RLock()
+
+    def get_state(self, endpoint: str) -> EndpointState:
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointState()
+            return self.endpoints[endpoint]
+
+    def pause(self, endpoint: str, seconds: float, reason: str):
+        if seconds <= 0:
+            return
+        with self.lock:
+            state = self.get_state(endpoint)
+            state.waits += 1
+            state.wait_time += seconds
+            logging.info('{}: waiting {:.1f}s ({}), waits: {}, retries: {}'.format(
+                endpoint, seconds, reason, state.waits, state.retries))
+        self.sleep(seconds)
+
+    def get_delay(self, endpoint: str):
+        # Returns (seconds, reason) to wait before the next request to endpoint.
+        with self.lock:
+            state = self.get_state(endpoint)
+            if state.remaining is None or state.reset is None:
+                return 0, None
+            now = self.clock()
+            if now >= state.reset:
+                return 0, None
+            if state.remaining <= 0:
+                return state.reset - now + 1, 'rate limit exhausted'
+            limit = state.limit or state.remaining
+            if state.remaining <= max(1, limit * PACING_FRACTION):
+                interval = (state.reset - now) / state.remaining
+                # The slot is taken right away, so that concurrent callers are spaced out too.
+                start = max(now, state.last_request + interval)
+                state.last_request = start
+                return start - now, 'pacing'
+            return 0, None
+
+    def wait(self, endpoint: str):
+        seconds, reason = self.get_delay(endpoint)
+        self.pause(endpoint, seconds, reason)
+
+    def update(self, endpoint: str, response: httpx.Response):
+        with self.lock:
+            state = self.get_state(endpoint)
+            state.last_request = self.clock()
+            state.requests += 1
+            headers = response.headers
+            try:
+                if 'x-rate-limit-limit' in headers:
+                    state.limit = int(headers['x-rate-limit-limit'])
+                if 'x-rate-limit-remaining' in headers:
+                    state.remaining = int(headers['x-rate-limit-remaining'])
+                if 'x-rate-limit-reset' in headers:
+                    state.reset = int(headers['x-rate-limit-reset'])
+            except ValueError:
+                logging.error('{}: malformed rate limit headers {}'.format(endpoint, dict(headers)))
+
+    def backoff(self, endpoint: str, attempt: int, reason: str):
+        with self.lock:
+            self.get_state(endpoint).retries += 1
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        self.pause(endpoint, random.uniform(delay / 2, delay), reason)
+
+    def request(self, endpoint: str, send) -> httpx.Response:
+        for attempt in range(self.max_retries + 1):
+            # No wait after the last attempt, the error is raised right away.
+            last_attempt = attempt == self.max_retries
+            self.wait(endpoint)
+            try:
+                response = send()
+            except httpx.TransportError as e:
+                logging.error('{}: request failed: {}'.format(endpoint, e))
+                if not last_attempt:
+                    self.backoff(endpoint, attempt, 'transport error')
+                continue
+            self.update(endpoint, response)
+            if response.status_code == 200:
+                return response
+            logging.error('{}: request returned an error: {} {}'.format(
+                endpoint, response.status_code, response.text))
+            if response.status_code == 429:
+                with self.lock:
+                    state = self.get_state(endpoint)
+                    state.remaining = 0
+                    reset = state.reset
+                if last_attempt:
+                    continue
+                if reset and reset > self.clock():
+                    with self.lock:
+                        state.retries += 1
+                    self.wait(endpoint)
+                else:
+                    self.backoff(endpoint, attempt, 'too many requests')
+            elif response.status_code >= 500:
+                if not last_attempt:
+                    self.backoff(endpoint, attempt, 'server error')
+            else:
+                raise RequestError('{} returned {}'.format(endpoint, response.status_code))
+        raise RequestError('{} failed after {} retries'.format(endpoint, self.max_retries))
+
+    def log_stats(self):
+        with self.lock:
+            endpoints = list(self.endpoints.items())
+        for endpoint, state in endpoints:
+            logging.info('{}: {} requests, {} waits ({:.1f}s), {} retries'.format(
+                endpoint, state.requests, state.waits, state.wait_time, state.retries))
@@ -1,41 +1,112 @@
 #!/usr/bin/python3
 
+import collections
+import contextlib
 import os
 
 import click
 
+from content_hash import (DEFAULT_CONTENT_CACHE_PATH, DEFAULT_WORKERS, PARTIAL_SIZE,
+                          ContentHashCache, ContentHasher)
+from dedup_plan import ACTIONS, PlanWriter
+from fs_walker import is_image, walk
+
 
 @click.group()
 def cli():
     pass
 
 
-def _is_image(filename):
-    f = filename.lower()
-    return f.endswith(".png") or f.endswith(".jpg") or \
-        f.endswith(".jpeg") or f.endswith(".bmp") or \
-        f.endswith(".gif") or '.jpg' in f or  f.endswith(".svg")
+def iter_files(root):
+    # Yields (path, stat) of the images under root.
+    for entry in walk([root], is_image):
+        try:
+            yield entry.path.replace('\\', '/'), entry.stat()
+        except OSError as e:
+            print('Problem:', e, 'with', entry.path)
+
+
+def find_same(base_files: list, scan_files: list, hasher: ContentHasher) -> list:
+    # Returns (base path, scan path, scan stat) of the scan files with the same content as a base
+    # file. Files are compared by size, then by a hash of their ends, and only the remaining ones
+    # are read in full.
+    base_by_size = collections.defaultdict(list)
+    for path, stat in base_files:
+        base_by_size[stat.st_size].append((path, stat))
+    base_paths = {os.path.abspath(path) for path, _ in base_files}
+    candidates = [(path, stat)
+                  for path, stat in scan_files
+                  if stat.st_size in base_by_size and os.path.abspath(path) not in base_paths]
+    sizes = {stat.st_size for _, stat in candidates}
+    bases = [file for size in sorted(sizes) for file in base_by_size[size]]
+    print('{} of {} scanned files have the size of a base file'.format(
+        len(candidates), len(scan_files)))
+
+    partials = hasher.hash_files(bases + candidates, 'partial')
+
+    def partial_key(file):
+        path, stat = file
+        return stat.st_size, partials.get(path)
+
+    base_keys = {partial_key(file) for file in bases if file[0] in partials}
+    candidates = [file for file in candidates if partial_key(file) in base_keys]
+    candidate_keys = {partial_key(file) for file in candidates}
+    bases = [file for file in bases if partial_key(file) in candidate_keys]
+    print('{} of them have the same first and last {} KiB'.format(len(candidates),
+                                                                  PARTIAL_SIZE // 1024))
+
+    # The partial hash of a small file covers all of it and is its full hash already.
+    fulls = {
+        path: partials[path]
+        for path, _ in bases + candidates
+        if not partials[path].startswith('partial:')
+    }
+    unhashed = [(path, stat) for path, stat in bases + candidates if path not in fulls]
+    fulls.update(hasher.hash_files(unhashed, 'full'))
+
+    base_fulls = {}
+    for path, stat in bases:
+        if path in fulls:
+            base_fulls.setdefault((stat.st_size, fulls[path]), path)
+    same = []
+    for path, stat in candidates:
+        base_path = base_fulls.get((stat.st_size, fulls.get(path)))
+        if base_path is not None:
+            same.append((base_path, path, stat))
+    return same
 
 
 @cli.command()
 @click.option('--base_dir', required=True, help="")
 @click.option('--scan_dir', required=True, help="")
-def run(base_dir, scan_dir):
-    base_dict = dict()
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            if _is_image(file):
-                path = os.path.join(root, file).replace('\\', '/')
-                base_dict[file] = {'path': path, 'size': os.path.getsize(path)}
-
-    for root, dirs, files in os.walk(scan_dir):
-        for file in files:
-            if file in base_dict:
-                details = base_dict[file]
-                path = os.path.join(root, file).replace('\\', '/')
-                if details['path'] != path and details['size'] == os.path.getsize(path):
-                    os.remove(path)
-                    print('Removed {}'.format(path))
+@click.option('--workers', default=DEFAULT_WORKERS, help="Number of hashing threads.")
+@click.option('--hash_cache_path',
+              default=DEFAULT_CONTENT_CACHE_PATH,
+              help="Path of the sqlite cache of file content hashes.")
+@click.option('--plan_path',
+              default=None,
+              help="Write the removals to this plan for dedup_plan.py apply instead of removing.")
+@click.option('--action',
+              type=click.Choice(ACTIONS),
+              default='delete',
+              help="Planned action for the duplicates.")
+def run(base_dir, scan_dir, workers, hash_cache_path, plan_path, action):
+    if action != 'delete' and not plan_path:
+        raise click.BadParameter('{} needs --plan_path'.format(action), param_hint='--action')
+    base_files = list(iter_files(base_dir))
+    scan_files = list(iter_files(scan_dir))
+    with ContentHashCache(hash_cache_path) as cache, ContentHasher(cache, workers) as hasher:
+        same = find_same(base_files, scan_files, hasher)
+    print('{} files are the same as a base file, {} hashes computed'.format(
+        len(same), hasher.hashed_files))
+
+    with PlanWriter(plan_path, action) if plan_path else contextlib.nullcontext() as plan:
+        for base_path, path, stat in same:
+            if plan is not None:
+                plan.add(base_path, path, stat)
+                continue
+            os.remove(path)
+            print('Removed {}'.format(path))
 
 
 if __name__ == "__main__":
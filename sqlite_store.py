@@ -0,0 +1,57 @@
+import sqlite3
+import threading
+
+BATCH_SIZE = 500
+
+
+class SqliteStore():
+    # Base of the sqlite stores. One connection is shared by the threads of a run under the lock,
+    # and rows are queued then written batch_size at a time by INSERT_SQL, which subclasses set
+    # along with their tables in create_tables.
+
+    INSERT_SQL = None
+    # Type of the pending rows, a set for the stores looking rows up before they are flushed.
+    PENDING_TYPE = list
+
+    def __init__(self, path: str, batch_size: int = BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = self.PENDING_TYPE()
+        # WAL lets several runs read while one of them commits, busy timeout covers the rest.
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def create_tables(self):
+        raise NotImplementedError
+
+    def queue(self, row: tuple):
+        with self.lock:
+            if isinstance(self.pending, set):
+                self.pending.add(row)
+            else:
+                self.pending.append(row)
+            if len(self.pending) < self.batch_size:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            with self.conn:
+                self.conn.executemany(self.INSERT_SQL, self.pending)
+            self.pending = self.PENDING_TYPE()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
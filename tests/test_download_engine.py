@@ -0,0 +1,126 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from download_engine import PART_CHUNK_SIZE, DownloadError, download_to_file
+
+BODY = os.urandom(300 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # /range serves ranges, /norange ignores them, /drop closes the connection half way through
+    # its first full response, /missing is a 404.
+    dropped = set()
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        Handler.requests.append((self.path, range_header))
+        if self.path == '/missing':
+            self.send_body(404, b'')
+            return
+        match = re.match(r'bytes=(\d+)-$', range_header or '')
+        if self.path == '/drop' and not match and self.path not in Handler.dropped:
+            Handler.dropped.add(self.path)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY[:len(BODY) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        if not match or self.path == '/norange':
+            self.send_body(200, BODY)
+            return
+        start = int(match.group(1))
+        if start >= len(BODY):
+            self.send_body(416, b'', [('Content-Range', 'bytes */{}'.format(len(BODY)))])
+            return
+        self.send_body(206, BODY[start:],
+                       [('Content-Range', 'bytes {}-{}/{}'.format(start,
+                                                                  len(BODY) - 1, len(BODY)))])
+
+
+@pytest.fixture
+def server_url():
+    Handler.dropped = set()
+    Handler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def session():
+    # No proxy from the environment for the local server.
+    with requests.Session() as session:
+        session.trust_env = False
+        yield session
+
+
+def write_part(output_path, size):
+    with open('{}.part'.format(output_path), 'wb') as f:
+        f.write(BODY[:size])
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_resumes_with_range(server_url, session, tmp_path):
+    output_path = str(tmp_path / 'image.jpg')
+    write_part(output_path, 1000)
+    assert download_to_file(session, server_url + '/range', output_path) == len(BODY)
+    assert read(output_path) == BODY
+    assert not os.path.exists(output_path + '.part')
+    assert Handler.requests == [('/range', 'bytes=1000-')]
+
+
+def test_restarts_when_range_is_ignored(server_url, session, tmp_path):
+    output_path = str(tmp_path / 'image.jpg')
+    write_part(output_path, 1000)
+    assert download_to_file(session, server_url + '/norange', output_path) == len(BODY)
+    assert read(output_path) == BODY
+
+
+def test_complete_part_is_kept_on_416(server_url, session, tmp_path):
+    output_path = str(tmp_path / 'image.jpg')
+    write_part(output_path, len(BODY))
+    assert download_to_file(session, server_url + '/range', output_path) == len(BODY)
+    assert read(output_path) == BODY
+    assert Handler.requests == [('/range', 'bytes={}-'.format(len(BODY)))]
+
+
+def test_resumes_after_dropped_connection(server_url, session, tmp_path):
+    output_path = str(tmp_path / 'image.jpg')
+    assert download_to_file(session, server_url + '/drop', output_path) == len(BODY)
+    assert read(output_path) == BODY
+    # The second request continues from the last complete chunk before the drop.
+    resumed_at = len(BODY) // 2 // PART_CHUNK_SIZE * PART_CHUNK_SIZE
+    assert Handler.requests == [('/drop', None), ('/drop', 'bytes={}-'.format(resumed_at))]
+
+
+def test_missing_file_leaves_nothing(server_url, session, tmp_path):
+    output_path = str(tmp_path / 'image.jpg')
+    with pytest.raises(DownloadError):
+        download_to_file(session, server_url + '/missing', output_path)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,74 @@
+class Media():
+    __slots__ = ('type', 'media_url_https', 'url', 'video_info')
+
+    def __init__(self, media: dict):
+        self.type = media.get('type', '')
+        self.media_url_https = media.get('media_url_https', '')
+        self.url = media.get('url', '')
+        self.video_info = media.get('video_info')
+
+
+class Tweet():
+    # timeline_id is the rest_id of the timeline entry the tweet was found in, which differs from
+    # rest_id for the retweeted or quoted tweet of a fallback.
+    __slots__ = ('rest_id', 'screen_name', 'medias', 'timeline_id')
+
+    def __init__(self, rest_id: str, screen_name: str, medias: list, timeline_id: str = None):
+        self.rest_id = rest_id
+        self.screen_name = screen_name
+        self.medias = medias
+        self.timeline_id = timeline_id or rest_id
+
+
+def get_screen_name(result: dict) -> str:
+    user = (((result.get('core') or {}).get('user_results') or {}).get('result') or {})
+    screen_name = (user.get('legacy') or {}).get('screen_name')
+    if screen_name is None:
+        screen_name = (user.get('core') or {}).get('screen_name')
+    return screen_name
+
+
+def extract_tweets(result: dict, seen: set):
+    # A tweet without media of its own falls back to the tweet it retweets or quotes, the
+    # same way a breadth-first search for 'extended_entities' used to. The fallback keeps the
+    # screen name of the outer tweet, the one that was liked or posted, so that excluding its
+    # author also excludes what it retweets or quotes.
+    screen_name = None
+    timeline_id = None
+    while result:
+        if result.get('__typename') == 'TweetWithVisibilityResults':
+            result = result.get('tweet') or {}
+        rest_id = result.get('rest_id')
+        if not rest_id:
+            return
+        legacy = result.get('legacy') or {}
+        medias = (legacy.get('extended_entities') or {}).get('media') or []
+        if screen_name is None:
+            screen_name = get_screen_name(result)
+            timeline_id = rest_id
+        if rest_id not in seen:
+            seen.add(rest_id)
+            yield Tweet(rest_id, screen_name, [Media(media) for media in medias], timeline_id)
+        if medias:
+            return
+        inner = legacy.get('retweeted_status_result') or result.get('quoted_status_result') or {}
+        result = inner.get('result')
+
+
+def iter_tweets(page: dict, seen: set = None):
+    if seen is None:
+        seen = set()
+    stack = [page]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            tweet_results = obj.get('tweet_results')
+            if isinstance(tweet_results, dict):
+                yield from extract_tweets(tweet_results.get('result'), seen)
+            stack.extend(
+                reversed([
+                    v for k, v in obj.items()
+                    if k != 'tweet_results' and isinstance(v, (dict, list))
+                ]))
+        elif isinstance(obj, list):
+            stack.extend(reversed([v for v in obj if isinstance(v, (dict, list))]))
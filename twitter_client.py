@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import threading
+import time
+from uuid import uuid4
+
+import httpx
+
+from graphql_api import GraphqlAPI
+from rate_limit import RateLimitScheduler
+
+USER_ID_CACHE_PATH = './user_ids.json'
+USER_ID_CACHE_TTL = 7 * 24 * 60 * 60
+TIMEOUT = 60
+
+
+class UserNotFoundError(Exception):
+    pass
+
+
+def get_headers(headers, cookies) -> dict:
+    authed_headers = headers | {
+        'cookie': '; '.join(f'{k}={v}' for k, v in cookies.items()),
+        'referer': 'https://twitter.com/',
+        'x-csrf-token': cookies.get('ct0', ''),
+        'x-guest-token': cookies.get('guest_token', ''),
+        'x-twitter-auth-type': 'OAuth2Session' if cookies.get('auth_token') else '',
+        'x-twitter-active-user': 'yes',
+        'x-twitter-client-language': 'en',
+    }
+    return dict(sorted({k.lower(): v for k, v in authed_headers.items()}.items()))
+
+
+def build_params(params: dict) -> dict:
+    return {k: json.dumps(v) for k, v in params.items()}
+
+
+class TwitterClient():
+
+    def __init__(self,
+                 cookie_path: str,
+                 user_id_cache_path: str = USER_ID_CACHE_PATH,
+                 user_id_cache_ttl: int = USER_ID_CACHE_TTL,
+                 scheduler: RateLimitScheduler = None):
+        self.cookie_path = cookie_path
+        self.cookie_mtime = None
+        self.cookies = {}
+        # api_name -> (url, authed headers, features), invalidated when the cookies change.
+        self.api_data = {}
+        # Batch jobs of the same account share the client from their own threads.
+        self.lock = threading.Lock()
+        self.user_id_cache_path = user_id_cache_path
+        self.user_id_cache_ttl = user_id_cache_ttl
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.client = httpx.Client(http2=True, timeout=TIMEOUT, follow_redirects=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.scheduler.log_stats()
+        self.client.close()
+
+    def load_cookies(self):
+        mtime = os.stat(self.cookie_path).st_mtime_ns
+        if mtime == self.cookie_mtime:
+            return
+        with open(self.cookie_path, 'r') as f:
+            self.cookies = json.load(f)
+        self.cookie_mtime = mtime
+        self.api_data = {}
+        logging.info('Loaded cookies from {}'.format(self.cookie_path))
+
+    def get_api_data(self, api_name: str):
+        with self.lock:
+            self.load_cookies()
+            if api_name not in self.api_data:
+                url, _, headers, features = GraphqlAPI.get_api_data(api_name)
+                self.api_data[api_name] = (url, get_headers(headers, self.cookies), features)
+            return self.api_data[api_name]
+
+    def send_get_request(self, api_name: str, params: dict = {}):
+
+        def send():
+            # Resolved on every attempt, so that a refreshed cookie file is picked up by retries.
+            url, headers, features = self.get_api_data(api_name)
+            return self.client.get(url,
+                                   params=build_params({
+                                       "variables": params,
+                                       "features": features
+                                   }),
+                                   headers=headers)
+
+        return self.scheduler.request(api_name, send).json()
+
+    def read_user_id_cache(self) -> dict:
+        if not os.path.exists(self.user_id_cache_path):
+            return {}
+        try:
+            with open(self.user_id_cache_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logging.error('Broken user id cache {}, ignored.'.format(self.user_id_cache_path))
+            return {}
+
+    def write_user_id_cache(self, user_id_cache: dict):
+        temp_path = '{}.{}.tmp'.format(self.user_id_cache_path, uuid4().hex)
+        with open(temp_path, 'w') as f:
+            json.dump(user_id_cache, f, indent=2)
+        os.replace(temp_path, self.user_id_cache_path)
+
+    def get_id_by_username(self, username: str) -> str:
+        user_id_cache = self.read_user_id_cache()
+        cached = user_id_cache.get(username)
+        if cached and time.time() - cached['time'] < self.user_id_cache_ttl:
+            return cached['rest_id']
+
+        json_response = self.send_get_request('UserByScreenName', {'screen_name': username})
+        # A suspended, deactivated or unknown account has no user, or one without a rest_id.
+        result = (((json_response.get('data') or {}).get('user') or {}).get('result') or {})
+        rest_id = result.get('rest_id')
+        if not rest_id:
+            raise UserNotFoundError('Twitter user {} not found: {}'.format(
+                username,
+                result.get('reason') or result.get('__typename') or 'no result'))
+        user_id_cache[username] = {'rest_id': rest_id, 'time': time.time()}
+        self.write_user_id_cache(user_id_cache)
+        return rest_id
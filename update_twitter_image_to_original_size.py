@@ -4,6 +4,15 @@ import click
 import logging
 import os
 import requests
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from check_manifest import DEFAULT_MANIFEST_PATH, CheckManifest
+from download_engine import (DEFAULT_CONCURRENCY, QUEUE_DEPTH_PER_WORKER, DownloadError,
+                             MissingFileError, complete_part, create_session, get_part_path,
+                             probe_size)
+from fs_walker import walk
 
 
 @click.group()
@@ -11,57 +20,134 @@ def cli():
     pass
 
 
-def get_proxies():
-    proxies = {}
-    https_proxy = os.environ.get("HTTPS_PROXY")
-    if https_proxy:
-        proxies["https"] = https_proxy
-    return proxies
-
-
-def check_image(file_dir, file_name):
+def is_tweet_image(file_dir, file_name) -> bool:
     file_path = os.path.join(file_dir, file_name)
+    if file_name.endswith('.part'):
+        # An interrupted download of check_image, resumed when its image is checked.
+        return False
     split = file_name.split('.')
     if len(split) != 2:
         logging.error('Unknow file: {}'.format(file_path))
-        return
+        return False
     if split[1] not in ['jpg', 'png']:
         logging.error('Unknow format: {} {}'.format(file_path, len(split[0])))
-        return
-    if len(split[0]) != 15:
-        return
+        return False
+    return len(split[0]) == 15
+
 
+def check_image(session, file_dir, file_name) -> str:
+    # Only the size is fetched first, the image itself is downloaded when it is going to
+    # replace the local file. The download goes to '<image>.part', which a rerun after a kill
+    # resumes, or removes once the image turns out not to need it.
+    file_path = os.path.join(file_dir, file_name)
+    part_path = get_part_path(file_path)
     orig_image_url = r"https://pbs.twimg.com/media/{}?name=orig".format(file_name)
-    r = requests.get(orig_image_url, proxies=get_proxies())
     old_size = os.path.getsize(file_path)
-    new_size = len(r.content)
+    try:
+        new_size = probe_size(session, orig_image_url)
+    except MissingFileError as e:
+        logging.error('{} ({}), {} (0): {}'.format(file_path, old_size, orig_image_url, e))
+        remove_part(part_path)
+        return 'missing'
+    except DownloadError as e:
+        # Not recorded, so that a rate limit or a server error is checked again next run.
+        logging.error('{} ({}), {} (0): {}'.format(file_path, old_size, orig_image_url, e))
+        return 'error'
     if old_size > new_size:
         logging.error('{} ({}), {} ({})'.format(file_path, old_size, orig_image_url, new_size))
     if old_size >= new_size:
-        return
+        remove_part(part_path)
+        return 'original'
+
+    try:
+        new_size = complete_part(session, orig_image_url, part_path)
+    except (DownloadError, requests.RequestException) as e:
+        logging.error('{} ({}), {} (0): {}'.format(file_path, old_size, orig_image_url, e))
+        return 'error'
+    if old_size >= new_size:
+        logging.error('{} ({}), {} ({})'.format(file_path, old_size, orig_image_url, new_size))
+        remove_part(part_path)
+        return 'original'
     logging.info('Replace {} ({}) with {} ({})'.format(file_path, old_size, orig_image_url,
                                                        new_size))
-    with open(file_path, "wb") as f:
-        f.write(r.content)
+    os.replace(part_path, file_path)
+    return 'upgraded'
+
+
+def remove_part(part_path):
+    if os.path.exists(part_path):
+        logging.info('Remove stale {}'.format(part_path))
+        os.remove(part_path)
 
 
 def scan(scan_dir):
-    for file_name in os.listdir(scan_dir):
-        file_path = os.path.join(scan_dir, file_name)
-        if os.path.isdir(file_path):
-            scan(file_path)
-        else:
-            check_image(scan_dir, file_name)
+    # Yields (file_dir, file_name, stat) of every tweet image, the directories are listed and the
+    # files stated in parallel.
+    for entry in walk([scan_dir]):
+        file_dir = os.path.dirname(entry.path)
+        if is_tweet_image(file_dir, entry.name):
+            yield file_dir, entry.name, entry.stat()
 
 
 @cli.command()
 @click.option('--scan_dir', default='./', help="")
+@click.option('--concurrency',
+              default=DEFAULT_CONCURRENCY,
+              help="Number of images probed or downloaded at the same time.")
+@click.option('--manifest_path',
+              default=DEFAULT_MANIFEST_PATH,
+              help="Path of the sqlite manifest of already checked images.")
+@click.option('--recheck_days',
+              default=0.0,
+              help="Check again images whose last check is older than this, 0 means never.")
 @click.option('--log_path',
               default='./update_twitter_image_to_original_size.log',
               help="Path to output logging's log.")
-def check(scan_dir, log_path):
-    logging.basicConfig(filename=log_path, format='%(asctime)s - %(message)s', level=logging.INFO)
-    scan(scan_dir)
+def check(scan_dir, concurrency, manifest_path, recheck_days, log_path):
+    logging.basicConfig(filename=log_path,
+                        format='%(asctime)s - %(threadName)s - %(message)s',
+                        level=logging.INFO)
+    concurrency = max(1, concurrency)
+    outcomes = Counter()
+    lock = threading.Lock()
+    # Bounds the queued checks, so that walking a large tree does not run ahead of the workers.
+    slots = threading.BoundedSemaphore(concurrency * QUEUE_DEPTH_PER_WORKER)
+    max_age = recheck_days * 24 * 60 * 60
+
+    def on_done(future, file_path, stat):
+        slots.release()
+        try:
+            outcome = future.result()
+        except Exception as e:
+            logging.error('Failed to check {}: {}'.format(file_path, e))
+            outcome = 'error'
+        with lock:
+            outcomes[outcome] += 1
+        if outcome == 'upgraded':
+            stat = os.stat(file_path)
+        if outcome != 'error':
+            manifest.record(file_path, stat, outcome)
+
+    with CheckManifest(manifest_path) as manifest, create_session(concurrency) as session, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='check') as executor:
+        for file_dir, file_name, stat in scan(scan_dir):
+            file_path = os.path.join(file_dir, file_name)
+            if manifest.is_checked(file_path, stat, max_age):
+                with lock:
+                    outcomes['skipped'] += 1
+                continue
+            slots.acquire()
+            future = executor.submit(check_image, session, file_dir, file_name)
+            future.add_done_callback(lambda future, file_path=file_path, stat=stat: on_done(
+                future, file_path, stat))
+
+    summary = ('Checked {} images: {} upgraded, {} already original, {} missing, {} failed, '
+               '{} skipped as already checked').format(
+                   sum(outcomes.values()) - outcomes['skipped'], outcomes['upgraded'],
+                   outcomes['original'], outcomes['missing'], outcomes['error'],
+                   outcomes['skipped'])
+    print(summary)
+    logging.info(summary)
 
 
 if __name__ == "__main__":